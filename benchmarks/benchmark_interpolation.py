@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the swiss_knife M-value interpolation algorithms.
+
+Generates synthetic LineStringM layers with varying vertex counts, densities
+of zero M-values and feature counts, runs the interpolation algorithms on
+them through processing.run in a headless QGIS application and prints one
+JSON record per run with throughput, peak memory, timings and the stage
+timers (read, extract, interpolate, rebuild, write) reported in the
+METRICS output of the algorithms.
+
+Runs are timed without any memory tracing. The peak memory of every case
+is measured by a separate run in a fresh process, as the peak resident set
+size of that process, which includes the memory allocated by QGIS and GEOS.
+
+Usage:
+
+    python3 benchmarks/benchmark_interpolation.py \\
+        --vertices 10 1000 --zero-density 0.5 0.9 --features 1000 \\
+        --output results.jsonl
+
+QGIS and its Python bindings must be importable, set QGIS_PREFIX_PATH if
+QGIS is not installed in the default prefix.
+"""
+
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from qgis.core import (Qgis,
+                       QgsFeature,
+                       QgsGeometry,
+                       QgsLineString,
+                       QgsVectorLayer)
+
+from swiss_knife_provider import start_qgis
+
+ALGORITHMS = ['interpolatemvalues', 'interpolatemvaluesnumpy']
+
+
+def generate_layer(feature_count, vertex_count, zero_density, seed=0):
+    """
+    Returns a memory layer of random walk LineStringM features. The first
+    and last vertex of every line have a known M-value, the others are zero
+    with the probability ``zero_density``.
+    """
+    rng = random.Random(seed)
+    layer = QgsVectorLayer('LineStringM?crs=EPSG:2056&field=id:integer', 'benchmark', 'memory')
+    features = []
+    for i in range(feature_count):
+        x = [2600000.0]
+        y = [1200000.0]
+        for _ in range(vertex_count - 1):
+            x.append(x[-1] + rng.uniform(-10, 10))
+            y.append(y[-1] + rng.uniform(-10, 10))
+        m = [0.0 if 0 < j < vertex_count - 1 and rng.random() < zero_density else float(j + 1)
+             for j in range(vertex_count)]
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([i])
+        feature.setGeometry(QgsGeometry(QgsLineString(x, y, [], m)))
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+def run_benchmark(algorithm, layer, parameters):
+    """
+    Runs an algorithm on a layer and returns its wall time and the metrics
+    it reported.
+    """
+    import processing
+
+    start = time.perf_counter()
+    result = processing.run('swissknife:{}'.format(algorithm), dict(parameters, INPUT=layer, OUTPUT='memory:'))
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(result['METRICS'])
+
+
+def max_rss_kb():
+    """
+    Returns the peak resident set size of the process in kilobytes.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # In bytes on macOS
+    return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+
+def measure_memory(case):
+    """
+    Generates the layer of a case, runs its algorithm once and returns the
+    peak resident set size of the process before and after the run. Called
+    in a fresh process by measure_memory_in_subprocess.
+    """
+    layer = generate_layer(case['features'], case['vertices'], case['zero_density'])
+    before = max_rss_kb()
+    run_benchmark(case['algorithm'], layer, case['parameters'])
+    return {'max_rss_kb_before_run': before, 'max_rss_kb': max_rss_kb()}
+
+
+def measure_memory_in_subprocess(case):
+    """
+    Runs measure_memory for a case in a fresh Python process, so that the
+    peak resident set size is the one of this case only.
+    """
+    output = subprocess.run(
+        [sys.executable, __file__, '--measure-memory', json.dumps(case)],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--algorithms', nargs='+', default=ALGORITHMS, choices=ALGORITHMS)
+    parser.add_argument('--vertices', nargs='+', type=int, default=[10, 100, 1000])
+    parser.add_argument('--zero-density', nargs='+', type=float, default=[0.5, 0.9])
+    parser.add_argument('--features', nargs='+', type=int, default=[1000])
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='JSON lines file the results are appended to, stdout if not set')
+    parser.add_argument('--measure-memory', metavar='CASE', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    app = start_qgis()
+    if args.measure_memory:
+        try:
+            print(json.dumps(measure_memory(json.loads(args.measure_memory))))
+        finally:
+            app.exitQgis()
+        return
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    environment = {
+        'python': platform.python_version(),
+        'qgis': Qgis.QGIS_VERSION,
+        'platform': platform.platform()
+    }
+    try:
+        for feature_count in args.features:
+            for vertex_count in args.vertices:
+                for zero_density in args.zero_density:
+                    start = time.perf_counter()
+                    layer = generate_layer(feature_count, vertex_count, zero_density)
+                    generate_time = time.perf_counter() - start
+
+                    for algorithm in args.algorithms:
+                        parameters = {'CHUNK_SIZE': args.chunk_size}
+                        timings = []
+                        stages = []
+                        for _ in range(args.repeat):
+                            elapsed, metrics = run_benchmark(algorithm, layer, parameters)
+                            timings.append(elapsed)
+                            stages.append({name: timer['seconds'] for name, timer in metrics['timers'].items()})
+                        best = min(timings)
+                        memory = measure_memory_in_subprocess({
+                            'algorithm': algorithm,
+                            'features': feature_count,
+                            'vertices': vertex_count,
+                            'zero_density': zero_density,
+                            'parameters': parameters
+                        })
+                        record = {
+                            'timestamp': time.time(),
+                            'algorithm': algorithm,
+                            'features': feature_count,
+                            'vertices_per_feature': vertex_count,
+                            'zero_density': zero_density,
+                            'parameters': parameters,
+                            'timings': {
+                                'generate': generate_time,
+                                'run': timings,
+                                'best': best,
+                                'stages': stages,
+                                'best_stages': stages[timings.index(best)]
+                            },
+                            'features_per_second': feature_count / best,
+                            'vertices_per_second': feature_count * vertex_count / best,
+                            # Peak resident set size of a fresh process running this
+                            # case once, before and after the run
+                            'memory': memory,
+                            'environment': environment
+                        }
+                        output.write(json.dumps(record) + '\n')
+                        output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        app.exitQgis()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load test of the swiss_knife Swiss Public Transport algorithms.
+
+Starts the local mock transport server, generates an OD table with a given
+number of rows and distinct stations, runs spt-getconnection and
+spt-getlocationfromname against the mock server through processing.run and
+prints one JSON record per run with the end-to-end throughput for every
+combination of concurrency and latency.
+
+Usage:
+
+    python3 benchmarks/load_test_spt.py --rows 5000 --stations 300 \\
+        --concurrency 1 4 16 --latency 0.05 0.2 --error-rate 0.01
+
+QGIS and its Python bindings must be importable, set QGIS_PREFIX_PATH if
+QGIS is not installed in the default prefix.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from qgis.core import (QgsFeature,
+                       QgsVectorLayer)
+
+from mock_transport_server import MockTransportServer
+from swiss_knife_provider import start_qgis
+
+
+def generate_layer(row_count, station_count, seed=0):
+    """
+    Returns a memory table of (from, to) station name pairs drawn among
+    ``station_count`` distinct names.
+    """
+    rng = random.Random(seed)
+    names = ['Station {}'.format(i) for i in range(station_count)]
+    layer = QgsVectorLayer('None?field=from:string&field=to:string', 'od', 'memory')
+    features = []
+    for _ in range(row_count):
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([rng.choice(names), rng.choice(names)])
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+def run_load_test(algorithm, parameters, server):
+    """
+    Runs an algorithm against the mock server and returns the elapsed time
+    and the number of requests the server received.
+    """
+    import processing
+
+    before = dict(server.stats)
+    start = time.perf_counter()
+    processing.run('swissknife:{}'.format(algorithm), dict(parameters, BASE_URL=server.url, OUTPUT='memory:'))
+    elapsed = time.perf_counter() - start
+    return elapsed, {name: server.stats[name] - before[name] for name in before}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--stations', type=int, default=200)
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16])
+    parser.add_argument('--latency', nargs='+', type=float, default=[0.05, 0.2])
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', type=float, default=0, help='requests per second, 0 for no limit')
+    parser.add_argument('--output', help='JSON lines file the results are appended to, stdout if not set')
+    args = parser.parse_args()
+
+    app = start_qgis()
+    layer = generate_layer(args.rows, args.stations)
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for latency in args.latency:
+            server = MockTransportServer(latency=latency, error_rate=args.error_rate).start()
+            try:
+                for concurrency in args.concurrency:
+                    runs = [
+                        ('spt-getconnection', {
+                            'INPUT_LAYER': layer, 'FROM_FIELD': 'from', 'TO_FIELD': 'to',
+                            'CONCURRENCY': concurrency
+                        }),
+                        ('spt-getlocationfromname', {
+                            'INPUT_LOCATIONS': layer, 'INPUT_FIELD_NAME': 'from',
+                            'CONCURRENCY': concurrency
+                        })
+                    ]
+                    for algorithm, parameters in runs:
+                        parameters.update({'USE_CACHE': False, 'RATE_LIMIT': args.rate_limit, 'MAX_RETRIES': 5})
+                        elapsed, requests = run_load_test(algorithm, parameters, server)
+                        record = {
+                            'timestamp': time.time(),
+                            'algorithm': algorithm,
+                            'rows': args.rows,
+                            'stations': args.stations,
+                            'concurrency': concurrency,
+                            'latency': latency,
+                            'error_rate': args.error_rate,
+                            'rate_limit': args.rate_limit,
+                            'elapsed': elapsed,
+                            'rows_per_second': args.rows / elapsed,
+                            'server': requests
+                        }
+                        output.write(json.dumps(record) + '\n')
+                        output.flush()
+            finally:
+                server.stop()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        app.exitQgis()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the transport.opendata.ch API.
+
+Serves /v1/locations and /v1/connections from recorded responses stored in
+the recordings folder, projected on the fields[] parameter if given.
+Recorded connections are moved in time so that the first one departs at
+the requested date and time.
+Queries which are not recorded get a synthetic but deterministic response,
+so any station names can be used. Latency and errors can be injected to
+simulate a slow or throttling server.
+
+Usage:
+
+    python3 benchmarks/mock_transport_server.py --port 8000 --latency 0.2 --error-rate 0.05
+
+then run the SPT algorithms with the API base URL set to
+http://localhost:8000/v1
+"""
+
+import argparse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings')
+
+
+def normalize(value):
+    return ' '.join(value.split()).casefold()
+
+
+def digest(*values):
+    """
+    Returns a stable integer derived from the given strings.
+    """
+    return int(hashlib.sha1('|'.join(values).encode('utf-8')).hexdigest()[:12], 16)
+
+
+def project(data, fields):
+    """
+    Keeps only the given slash separated field paths of a response, like
+    the fields[] parameter of the API. Paths apply to every item of lists.
+    """
+    if isinstance(data, list):
+        return [project(item, fields) for item in data]
+    if not isinstance(data, dict):
+        return data
+    children = {}
+    for field in fields:
+        name, _, rest = field.partition('/')
+        if name in data:
+            children.setdefault(name, []).append(rest)
+    return {
+        name: data[name] if '' in rests else project(data[name], rests)
+        for name, rests in children.items()
+    }
+
+
+def requested_departure(date, time_):
+    """
+    Returns the requested departure as a naive local datetime, now if the
+    date or time are missing or invalid.
+    """
+    try:
+        return datetime.strptime('{} {}'.format(date, time_), '%Y-%m-%d %H:%M')
+    except ValueError:
+        return datetime.now().replace(second=0, microsecond=0)
+
+
+def shift_times(data, delta):
+    """
+    Returns a copy of a response with all its departure and arrival times
+    moved by ``delta``, a timedelta: the *Timestamp fields and the ISO 8601
+    departure and arrival fields, at any depth.
+    """
+    if isinstance(data, list):
+        return [shift_times(item, delta) for item in data]
+    if not isinstance(data, dict):
+        return data
+    shifted = {}
+    for name, value in data.items():
+        if name.endswith('Timestamp') and isinstance(value, int):
+            value += int(delta.total_seconds())
+        elif name in ('departure', 'arrival') and isinstance(value, str):
+            try:
+                value = (datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z') + delta).strftime('%Y-%m-%dT%H:%M:%S%z')
+            except ValueError:
+                pass
+        else:
+            value = shift_times(value, delta)
+        shifted[name] = value
+    return shifted
+
+
+def synthetic_station(query):
+    seed = digest(query)
+    return {
+        'id': str(8500000 + seed % 100000),
+        'name': query.strip().title(),
+        'score': None,
+        'coordinate': {
+            'type': 'WGS84',
+            'x': 45.9 + (seed % 10000) / 10000 * 1.8,
+            'y': 6.0 + (seed // 10000 % 10000) / 10000 * 4.4
+        },
+        'distance': None,
+        'icon': 'train'
+    }
+
+
+def synthetic_connections(origin, destination, date, time_, limit):
+    seed = digest(origin, destination)
+    departure = requested_departure(date, time_)
+    duration = 10 + seed % 110
+    transfers = seed % 3
+    connections = []
+    for i in range(limit):
+        start = departure + timedelta(minutes=(seed % 15) + i * 30)
+        end = start + timedelta(minutes=duration + (i % 2) * 7)
+        products = ['IC{}'.format(1 + (seed + k) % 9) for k in range(transfers + 1)]
+        connections.append({
+            'from': {
+                'station': synthetic_station(origin),
+                'departure': start.strftime('%Y-%m-%dT%H:%M:%S+0100'),
+                'departureTimestamp': int(start.timestamp()),
+                'platform': str(1 + seed % 12)
+            },
+            'to': {
+                'station': synthetic_station(destination),
+                'arrival': end.strftime('%Y-%m-%dT%H:%M:%S+0100'),
+                'arrivalTimestamp': int(end.timestamp()),
+                'platform': str(1 + (seed // 7) % 12)
+            },
+            'duration': '00d{:02d}:{:02d}:00'.format(*divmod(int((end - start).total_seconds() // 60), 60)),
+            'transfers': transfers,
+            'products': products,
+            'sections': []
+        })
+    return connections
+
+
+class MockTransportServer(ThreadingMixIn, HTTPServer):
+    """
+    Threaded HTTP server answering like transport.opendata.ch.
+
+    ``latency`` is the mean response delay in seconds, ``error_rate`` the
+    probability of answering with a 429 or 503 error instead.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, recordings_dir=RECORDINGS_DIR, seed=0):
+        super().__init__(('127.0.0.1', port), MockTransportHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0}
+        self.recordings = {}
+        for endpoint in ('locations', 'connections'):
+            path = os.path.join(recordings_dir, endpoint + '.json')
+            if os.path.exists(path):
+                with open(path) as f:
+                    self.recordings[endpoint] = {normalize(key): value for key, value in json.load(f).items()}
+            else:
+                self.recordings[endpoint] = {}
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/v1'.format(self.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def draw(self):
+        """
+        Returns the delay and whether to fail the next request.
+        """
+        with self.lock:
+            self.stats['requests'] += 1
+            delay = self.random.expovariate(1 / self.latency) if self.latency > 0 else 0
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.stats['errors'] += 1
+        return delay, fail
+
+    def locations(self, query):
+        params = {name: values[-1] for name, values in query.items()}
+        name = params.get('query', '')
+        recorded = self.recordings['locations'].get(normalize(name))
+        if recorded is not None:
+            return recorded
+        return {'stations': [synthetic_station(name)] if name else []}
+
+    def connections(self, query):
+        params = {name: values[-1] for name, values in query.items()}
+        origin = params.get('from', '')
+        destination = params.get('to', '')
+        recorded = self.recordings['connections'].get(normalize('{}|{}'.format(origin, destination)))
+        if recorded is not None:
+            departures = [
+                connection['from']['departureTimestamp'] for connection in recorded.get('connections', [])
+                if connection.get('from', {}).get('departureTimestamp') is not None
+            ]
+            if not departures:
+                return recorded
+            departure = requested_departure(params.get('date', ''), params.get('time', ''))
+            return shift_times(recorded, timedelta(seconds=departure.timestamp() - min(departures)))
+        limit = min(16, max(1, int(params.get('limit', 4))))
+        return {
+            'connections': synthetic_connections(
+                origin, destination, params.get('date', ''), params.get('time', '08:00'), limit
+            ),
+            'from': synthetic_station(origin),
+            'to': synthetic_station(destination),
+            'stations': {'from': [synthetic_station(origin)], 'to': [synthetic_station(destination)]}
+        }
+
+
+class MockTransportHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/stats':
+            return self.reply(200, self.server.stats)
+
+        delay, fail = self.server.draw()
+        time.sleep(delay)
+        if fail:
+            status = self.server.random.choice((429, 503))
+            return self.reply(status, {'errors': [{'message': 'Injected error'}]}, {'Retry-After': '1'})
+
+        if url.path == '/v1/locations':
+            data = self.server.locations(query)
+        elif url.path == '/v1/connections':
+            data = self.server.connections(query)
+        else:
+            return self.reply(404, {'errors': [{'message': 'Not found'}]})
+        if query.get('fields[]'):
+            data = project(data, query['fields[]'])
+        return self.reply(200, data)
+
+    def reply(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='mean response delay in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of a 429 or 503 response')
+    parser.add_argument('--recordings', default=RECORDINGS_DIR)
+    args = parser.parse_args()
+
+    server = MockTransportServer(args.port, args.latency, args.error_rate, args.recordings)
+    print('Serving on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
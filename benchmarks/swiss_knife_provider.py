@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+"""
+Headless QGIS application and processing provider used by the benchmarks to
+run the swiss_knife algorithms through processing.run.
+"""
+
+import os
+import sys
+
+from qgis.core import (QgsApplication,
+                       QgsProcessingProvider)
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'collections', 'swiss_knife', 'processing')
+
+
+class SwissKnifeProvider(QgsProcessingProvider):
+    """
+    Provider exposing the swiss_knife algorithms to processing.run under
+    the 'swissknife' prefix.
+    """
+
+    def loadAlgorithms(self):
+        sys.path.insert(0, SCRIPTS_DIR)
+        from interpolateMvalues_Line import InterpolateMValues
+        from interpolateMvalues_Line_numpy import InterpolateMValuesNumpy
+        from swiss_public_transport_connection_sweep import SwissPublicTransportConnectionSweep
+        from swiss_public_transport_get_connection import SwissPublicTransportGetConnection
+        from swiss_public_transport_get_location_from_name import SwissPublicTransportGetLocationFromName
+        from swiss_public_transport_travel_time_matrix import SwissPublicTransportTravelTimeMatrix
+        self.addAlgorithm(InterpolateMValues())
+        self.addAlgorithm(InterpolateMValuesNumpy())
+        self.addAlgorithm(SwissPublicTransportConnectionSweep())
+        self.addAlgorithm(SwissPublicTransportGetConnection())
+        self.addAlgorithm(SwissPublicTransportGetLocationFromName())
+        self.addAlgorithm(SwissPublicTransportTravelTimeMatrix())
+
+    def id(self):
+        return 'swissknife'
+
+    def name(self):
+        return 'Swiss Knife'
+
+
+def start_qgis():
+    """
+    Starts a headless QGIS application with processing and the swiss_knife
+    provider, returns the application.
+    """
+    app = QgsApplication([], False)
+    app.initQgis()
+    sys.path.append(os.path.join(QgsApplication.pkgDataPath(), 'python', 'plugins'))
+    from processing.core.Processing import Processing
+    Processing.initialize()
+    QgsApplication.processingRegistry().addProvider(SwissKnifeProvider())
+    return app
@@ -0,0 +1,597 @@
+#-*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Chunked M-value interpolation shared by the interpolation algorithms.
+
+Lines are processed in chunks stored as ragged arrays: the vertices of all
+lines of a chunk are concatenated in flat x, y and m arrays, the vertices of
+line i being those between offsets[i] and offsets[i+1]. A kernel receives a
+whole chunk and returns the interpolated M-values of all its vertices.
+
+Multi-part geometries are flattened in the same arrays, the ``parts``
+offsets delimit every part. Distances along the line do not include the
+gaps between parts. M-values are interpolated per part, or per feature
+across all its parts.
+
+Interpolated features are written to a new sink, or back to the input
+layer with GeometryChangeSink, which only rewrites their geometries.
+
+Which M-values are missing, how interpolated M-values are rounded and how
+line ends are handled are options of the interpolation kernel, defined in
+interpolateMvalues_kernel and bound with functools.partial by the
+algorithms. The algorithms share their parameters and processing through
+InterpolateMValuesMixin.
+"""
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsFeature,
+                       QgsFeatureSink,
+                       QgsGeometry,
+                       QgsGeometryCollection,
+                       QgsLineString,
+                       QgsMultiLineString,
+                       QgsPoint,
+                       QgsProcessing,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingException,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterFeatureSink,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterVectorLayer,
+                       QgsVectorDataProvider,
+                       QgsWkbTypes)
+import functools
+import itertools
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(__file__))
+from interpolateMvalues_kernel import (  # noqa: E402, F401
+    ENDS_KEEP, ENDS_LINEAR, ENDS_NEAREST, MISSING_BELOW, MISSING_NAN, MISSING_ZERO,
+    extrapolate, interpolate_masked, missing_mask
+)
+from swiss_knife_metrics import AlgorithmMetrics, Metrics  # noqa: E402
+
+
+class LineChunk:
+    """
+    Chunk of line features with M-values packed as ragged arrays.
+
+    LineStrings and MultiLineStrings are read and rebuilt with the bulk
+    coordinate accessors. Curved geometries have none, their vertices are
+    read and moved one by one, and distances between their vertices are
+    measured as straight segments.
+    """
+
+    def __init__(self, across_parts=False):
+        self.across_parts = across_parts
+        self.features = []
+        self.layouts = []
+        self.x = []
+        self.y = []
+        self.m = []
+        self.parts = [0]
+        self.feature_parts = [0]
+
+    def __len__(self):
+        return len(self.features)
+
+    @property
+    def offsets(self):
+        """
+        Vertex offsets of the lines M-values are interpolated along.
+        """
+        if self.across_parts:
+            return [self.parts[i] for i in self.feature_parts]
+        return self.parts
+
+    def append(self, feature):
+        """
+        Adds a feature to the chunk, returns False if its geometry is not a
+        line with M-values.
+        """
+        geometry = feature.geometry()
+        abstract = geometry.constGet()
+        if (abstract is None
+                or QgsWkbTypes.geometryType(abstract.wkbType()) != QgsWkbTypes.LineGeometry
+                or not QgsWkbTypes.hasM(abstract.wkbType())):
+            return False
+
+        if isinstance(abstract, QgsGeometryCollection):
+            parts = [abstract.geometryN(i) for i in range(abstract.numGeometries())]
+        else:
+            parts = [abstract]
+
+        if all(isinstance(part, QgsLineString) for part in parts):
+            for part in parts:
+                self.x.extend(part.xVector())
+                self.y.extend(part.yVector())
+                self.m.extend(part.mVector())
+                self.parts.append(len(self.m))
+            layout = (geometry.isMultipart(), [part.zVector() for part in parts])
+        else:
+            layout = None
+            vertex = 0
+            for part in parts:
+                for _ in range(part.nCoordinates()):
+                    point = geometry.vertexAt(vertex)
+                    self.x.append(point.x())
+                    self.y.append(point.y())
+                    self.m.append(point.m())
+                    vertex += 1
+                self.parts.append(len(self.m))
+
+        self.features.append(feature)
+        self.layouts.append(layout)
+        self.feature_parts.append(len(self.parts) - 1)
+        return True
+
+    def run(self, kernel):
+        """
+        Runs the kernel on the whole chunk and returns the interpolated
+        M-values.
+        """
+        m_interpolated = kernel(self.x, self.y, self.m, self.offsets, self.parts)
+        if isinstance(m_interpolated, np.ndarray):
+            m_interpolated = m_interpolated.tolist()
+        return m_interpolated
+
+    def build(self, m_interpolated, changed_only=False):
+        """
+        Returns the features of the chunk with the given M-values. With
+        ``changed_only``, the features whose M-values are all unchanged are
+        left out.
+        """
+        if changed_only:
+            new = np.asarray(m_interpolated, dtype=np.float64)
+            old = np.asarray(self.m, dtype=np.float64)
+            changed = ~((new == old) | (np.isnan(new) & np.isnan(old)))
+
+        features = []
+        for i, feature in enumerate(self.features):
+            first, last = self.feature_parts[i], self.feature_parts[i + 1]
+            if changed_only and not changed[self.parts[first]:self.parts[last]].any():
+                continue
+            layout = self.layouts[i]
+
+            if layout is None:
+                geometry = QgsGeometry(feature.geometry())
+                start = self.parts[first]
+                for vertex in range(self.parts[last] - start):
+                    point = QgsPoint(geometry.vertexAt(vertex))
+                    point.setM(m_interpolated[start + vertex])
+                    geometry.moveVertex(point, vertex)
+            else:
+                multipart, z = layout
+                lines = [
+                    QgsLineString(self.x[start:end], self.y[start:end], z[k], m_interpolated[start:end])
+                    for k, (start, end) in enumerate(zip(self.parts[first:last], self.parts[first + 1:last + 1]))
+                ]
+                if multipart:
+                    multi_line = QgsMultiLineString()
+                    for line in lines:
+                        multi_line.addGeometry(line)
+                    geometry = QgsGeometry(multi_line)
+                else:
+                    geometry = QgsGeometry(lines[0])
+
+            feat_new = QgsFeature(feature)
+            feat_new.setGeometry(geometry)
+            features.append(feat_new)
+        return features
+
+
+def pack_features(features, feedback, across_parts=False):
+    """
+    Packs a list of features in a chunk, features which are not lines with
+    M-values are reported and skipped. Returns the chunk and the number of
+    skipped features.
+    """
+    chunk = LineChunk(across_parts)
+    bad = 0
+    for feature in features:
+        if not chunk.append(feature):
+            feedback.pushInfo('Feature {} skipped, its geometry is not a line with M-values'.format(feature.id()))
+            bad += 1
+    return chunk, bad
+
+
+def interpolate_features(features, kernel, feedback, across_parts=False):
+    """
+    Interpolates the M-values of a list of features as a single chunk.
+    Returns the interpolated features and the number of skipped features.
+    """
+    chunk, bad = pack_features(features, feedback, across_parts)
+    return chunk.build(chunk.run(kernel)), bad
+
+
+def process_in_chunks(source, sink, kernel, chunk_size, feedback, across_parts=False, metrics=None,
+                      changed_only=False):
+    """
+    Reads the source in chunks of ``chunk_size`` features, interpolates
+    every chunk with one kernel call and writes it to the sink. Returns the
+    number of skipped features.
+
+    With ``changed_only``, only the features whose M-values changed are
+    written to the sink, the others are counted as unchanged.
+
+    The time spent reading, extracting vertices, interpolating, rebuilding
+    geometries and writing is recorded in ``metrics`` if given.
+    """
+    return interpolate_stream(
+        source.getFeatures(), sink, kernel, chunk_size, feedback, across_parts, metrics,
+        source.featureCount(), changed_only
+    )
+
+
+def interpolate_stream(features, sink, kernel, chunk_size, feedback, across_parts=False, metrics=None,
+                       total=0, changed_only=False):
+    """
+    Same as process_in_chunks for any iterable of features, ``total`` is
+    their number if known, for progress reporting.
+    """
+    metrics = metrics or Metrics()
+    done = 0
+    bad = 0
+    iterator = iter(features)
+    while not feedback.isCanceled():
+        with metrics.timer('read'):
+            batch = list(itertools.islice(iterator, chunk_size))
+        if not batch:
+            break
+
+        with metrics.timer('extract'):
+            chunk = LineChunk(across_parts)
+            for feature in batch:
+                if not chunk.append(feature):
+                    feedback.pushInfo(
+                        'Feature {} skipped, its geometry is not a line with M-values'.format(feature.id())
+                    )
+                    bad += 1
+                    metrics.count('skipped')
+        metrics.count('features', len(chunk))
+        metrics.count('vertices', len(chunk.m))
+        with metrics.timer('interpolate'):
+            m_interpolated = chunk.run(kernel)
+        with metrics.timer('rebuild'):
+            rebuilt = chunk.build(m_interpolated, changed_only)
+        if changed_only:
+            metrics.count('unchanged', len(chunk) - len(rebuilt))
+        with metrics.timer('write'):
+            sink.addFeatures(rebuilt, QgsFeatureSink.FastInsert)
+
+        done += len(batch)
+        if total > 0:
+            feedback.setProgress(done / total * 100)
+    return bad
+
+
+class GeometryChangeSink:
+    """
+    Feature sink writing the geometries of features back to the layer they
+    were read from, by feature id, without touching their attributes. Only
+    modified features should be added, see ``changed_only`` of
+    process_in_chunks.
+
+    Nothing is written while the features are added, the layer is still
+    being read: the geometries are kept until ``flush``, which must be
+    called once the source is exhausted and commits them with one
+    changeGeometryValues call, i.e. one provider transaction, per
+    ``batch_size`` features.
+    """
+
+    def __init__(self, layer, batch_size=10000):
+        self.layer = layer
+        self.provider = layer.dataProvider()
+        self.batch_size = batch_size
+        self.count = 0
+        self._ids = []
+        self._geometries = []
+
+        if layer.isEditable():
+            raise QgsProcessingException('Layer {} must not be in edit mode to be updated in place'.format(
+                layer.name()))
+        if not self.provider.capabilities() & QgsVectorDataProvider.ChangeGeometries:
+            raise QgsProcessingException('The geometries of layer {} cannot be changed'.format(layer.name()))
+
+    def addFeatures(self, features, flags=0):
+        for feature in features:
+            self._ids.append(feature.id())
+            self._geometries.append(feature.geometry())
+        return True
+
+    def flush(self):
+        for start in range(0, len(self._ids), self.batch_size):
+            geometries = dict(zip(self._ids[start:start + self.batch_size],
+                                  self._geometries[start:start + self.batch_size]))
+            if not self.provider.changeGeometryValues(geometries):
+                raise QgsProcessingException('Could not change geometries: {}'.format(self.provider.lastError()))
+            self.count += len(geometries)
+        self._ids = []
+        self._geometries = []
+
+
+class InterpolateMValuesMixin(AlgorithmMetrics):
+    """
+    Parameters and processing shared by the M-value interpolation
+    algorithms, which only set their names, display strings and the default
+    handling of the line ends.
+    """
+
+    # Constants used to refer to parameters and outputs. They will be
+    # used when calling the algorithm from another algorithm, or when
+    # calling from the QGIS console.
+
+    INPUT = 'INPUT'
+    OUTPUT = 'OUTPUT'
+    CHUNK_SIZE = 'CHUNK_SIZE'
+    ACROSS_PARTS = 'ACROSS_PARTS'
+    MISSING_VALUE = 'MISSING_VALUE'
+    THRESHOLD = 'THRESHOLD'
+    DECIMALS = 'DECIMALS'
+    ENDS = 'ENDS'
+    INCREMENTAL_OUTPUT = 'INCREMENTAL_OUTPUT'
+    KEY_FIELD = 'KEY_FIELD'
+    IN_PLACE = 'IN_PLACE'
+
+    MISSING_VALUES = [MISSING_ZERO, MISSING_NAN, MISSING_BELOW]
+    ENDS_OPTIONS = [ENDS_KEEP, ENDS_NEAREST, ENDS_LINEAR]
+
+    # Position in ENDS_OPTIONS of the default handling of the line ends
+    ENDS_DEFAULT = 1
+
+    SKIPPED = 'SKIPPED'
+    CHANGED = 'CHANGED'
+    UNCHANGED = 'UNCHANGED'
+    DELETED = 'DELETED'
+    UPDATED = 'UPDATED'
+    METRIC_OUTPUTS = (SKIPPED, CHANGED, UNCHANGED, DELETED, UPDATED)
+
+    def tr(self, string):
+        """
+        Returns a translatable string with the self.tr() function.
+        """
+        return QCoreApplication.translate('Processing', string)
+
+    def flags(self):
+        """
+        Runs in the main thread: updating the input in place or an existing
+        output writes to the provider of a layer of the project.
+        """
+        return super().flags() | QgsProcessingAlgorithm.FlagNoThreading
+
+    def initAlgorithm(self, config=None):
+        """
+        Here we define the inputs and output of the algorithm, along
+        with some other properties.
+        """
+
+        # We add the input vector features source. It can have any kind of
+        # geometry.
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT,
+                self.tr('Input layer'),
+                [QgsProcessing.TypeVectorAnyGeometry]
+            )
+        )
+
+        # We add a feature sink in which to store our processed features (this
+        # usually takes the form of a newly created vector layer when the
+        # algorithm is run in QGIS).
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT,
+                self.tr('Output layer'),
+                optional=True,
+                createByDefault=True
+            )
+        )
+
+        # Features are read, interpolated and written in chunks of this size
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CHUNK_SIZE,
+                self.tr('Number of features processed per chunk'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=1000
+            )
+        )
+
+        # Multi-part lines are interpolated part by part unless asked otherwise
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.ACROSS_PARTS,
+                self.tr('Interpolate across the parts of multi-part lines'),
+                defaultValue=False
+            )
+        )
+
+        # M-values to interpolate, NaN M-values are always interpolated
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.MISSING_VALUE,
+                self.tr('Missing M-values'),
+                options=[
+                    self.tr('Zero or NaN'),
+                    self.tr('NaN only'),
+                    self.tr('Below the threshold or NaN')
+                ],
+                defaultValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.THRESHOLD,
+                self.tr('Threshold of missing M-values'),
+                type=QgsProcessingParameterNumber.Double,
+                defaultValue=0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.DECIMALS,
+                self.tr('Decimals of interpolated M-values (-1 for no rounding)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=-1,
+                defaultValue=0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.ENDS,
+                self.tr('Missing M-values at the line ends'),
+                options=[
+                    self.tr('Keep'),
+                    self.tr('Nearest known M-value'),
+                    self.tr('Extrapolate linearly')
+                ],
+                defaultValue=self.ENDS_DEFAULT
+            )
+        )
+
+        # Output of a previous run updated with the changed features only,
+        # matched by key
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.INCREMENTAL_OUTPUT,
+                self.tr('Existing output to update incrementally'),
+                [QgsProcessing.TypeVectorLine],
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.KEY_FIELD,
+                self.tr('Key field matching input and existing output features'),
+                parentLayerParameterName=self.INPUT,
+                optional=True
+            )
+        )
+
+        # The geometries of the input layer are rewritten instead of
+        # copying all its features to a new output
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.IN_PLACE,
+                self.tr('Update the M-values of the input layer in place'),
+                defaultValue=False
+            )
+        )
+
+        # Timings of the processing stages and number of skipped features
+        self.addMetricsParameters()
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        self.num_bad = 0
+        self.across_parts = self.parameterAsBoolean(parameters, self.ACROSS_PARTS, context)
+        decimals = self.parameterAsInt(parameters, self.DECIMALS, context)
+        self.kernel = functools.partial(
+            interpolate_masked,
+            missing=self.MISSING_VALUES[self.parameterAsEnum(parameters, self.MISSING_VALUE, context)],
+            threshold=self.parameterAsDouble(parameters, self.THRESHOLD, context),
+            decimals=None if decimals < 0 else decimals,
+            ends=self.ENDS_OPTIONS[self.parameterAsEnum(parameters, self.ENDS, context)]
+        )
+        return True
+
+    def processAlgorithm(self, parameters, context, feedback):
+        """
+        Processes the input in chunks instead of feature by feature.
+        """
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        chunk_size = self.parameterAsInt(parameters, self.CHUNK_SIZE, context)
+        metrics = Metrics()
+
+        existing = self.parameterAsVectorLayer(parameters, self.INCREMENTAL_OUTPUT, context)
+        if self.parameterAsBoolean(parameters, self.IN_PLACE, context):
+            if existing is not None:
+                raise QgsProcessingException(
+                    self.tr('The input layer cannot be updated in place and incrementally at once')
+                )
+            dest_id = self.interpolateInPlace(source, parameters, context, feedback, chunk_size, metrics)
+        elif existing is not None:
+            key_field = self.parameterAsString(parameters, self.KEY_FIELD, context)
+            if not key_field:
+                raise QgsProcessingException(self.tr('A key field is required to update an existing output'))
+            # The previous fingerprints are discarded when the options change
+            options = repr((sorted(self.kernel.keywords.items()), self.across_parts))
+            # The incremental module imports this one
+            from interpolateMvalues_incremental import process_incrementally
+            self.num_bad = process_incrementally(
+                source, existing, key_field, self.kernel, options, chunk_size, feedback,
+                self.across_parts, metrics
+            )
+            dest_id = existing.id()
+        else:
+            dest_id = self.interpolateToSink(source, parameters, context, feedback, chunk_size, metrics)
+        if self.num_bad:
+            feedback.pushInfo(self.tr('{} features skipped').format(self.num_bad))
+
+        results = {self.OUTPUT: dest_id}
+        results.update(self.reportMetrics(metrics, parameters, context, feedback))
+        return results
+
+    def interpolateInPlace(self, source, parameters, context, feedback, chunk_size, metrics):
+        """
+        Writes the interpolated geometries back to the input layer, returns
+        its id.
+        """
+        layer = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        if layer is None:
+            raise QgsProcessingException(self.tr('Only a vector layer can be updated in place'))
+
+        # Features without any missing M-value are not rewritten, the others
+        # are written once all the features are read
+        sink = GeometryChangeSink(layer)
+        self.num_bad = process_in_chunks(
+            source, sink, self.kernel, chunk_size, feedback, self.across_parts, metrics,
+            changed_only=True
+        )
+        if feedback.isCanceled():
+            return layer.id()
+        with metrics.timer('write'):
+            sink.flush()
+        metrics.count('updated', sink.count)
+        layer.triggerRepaint()
+        return layer.id()
+
+    def interpolateToSink(self, source, parameters, context, feedback, chunk_size, metrics):
+        """
+        Interpolates all the features to a new output, returns its id.
+        """
+        (sink, dest_id) = self.parameterAsSink(
+            parameters, self.OUTPUT, context,
+            source.fields(), source.wkbType(), source.sourceCrs()
+        )
+        if sink is None:
+            raise QgsProcessingException(self.invalidSinkError(parameters, self.OUTPUT))
+
+        self.num_bad = process_in_chunks(
+            source, sink, self.kernel, chunk_size, feedback, self.across_parts, metrics
+        )
+        return dest_id
+
+    def processFeature(self, feature, context, feedback):
+        """
+        Interpolates a single feature, used when editing features in place.
+        """
+        features, bad = interpolate_features([feature], self.kernel, feedback, self.across_parts)
+        self.num_bad += bad
+        return features
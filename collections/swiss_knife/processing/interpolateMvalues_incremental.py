@@ -0,0 +1,225 @@
+#-*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+Incremental M-value interpolation shared by the interpolation algorithms.
+
+The output of a previous run is updated in place: only the input features
+whose geometry or attributes changed since that run are interpolated again.
+Changes are detected with a fingerprint (hash of the geometry WKB and of the
+attributes) of every input feature, stored in a sidecar SQLite index next to
+the output. Input and output features are matched by a key field.
+"""
+
+from qgis.core import (QgsApplication,
+                       QgsFeature,
+                       QgsFeatureRequest,
+                       QgsProcessingException,
+                       QgsProviderRegistry,
+                       QgsVectorDataProvider)
+import hashlib
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+from interpolateMvalues_core import interpolate_stream  # noqa: E402
+from swiss_knife_metrics import Metrics  # noqa: E402
+
+# Sidecar indexes of outputs which are not files, relative to the QGIS
+# settings directory
+FINGERPRINTS_DIR = os.path.join('swiss_knife', 'fingerprints')
+
+
+def fingerprint(feature):
+    """
+    Returns a hash of the geometry and attributes of a feature.
+    """
+    digest = hashlib.sha1(bytes(feature.geometry().asWkb()))
+    digest.update(repr(feature.attributes()).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fingerprints_path(layer):
+    """
+    Returns the path of the sidecar index of an output layer: next to the
+    layer file, or in the QGIS settings directory for database layers.
+    """
+    parts = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+    path = parts.get('path')
+    if path and os.path.isfile(path):
+        layer_name = parts.get('layerName') or ''
+        return '{}{}.fingerprints.sqlite'.format(path, '.' + layer_name if layer_name else '')
+    name = hashlib.sha1(layer.source().encode('utf-8')).hexdigest()
+    return os.path.join(QgsApplication.qgisSettingsDirPath(), FINGERPRINTS_DIR, name + '.sqlite')
+
+
+class FingerprintIndex:
+    """
+    Fingerprints of the input features of the last run, by key, stored in a
+    SQLite database. The index is cleared when the interpolation options
+    change, so that every feature is interpolated again.
+    """
+
+    def __init__(self, path, options):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS fingerprints (key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'options'").fetchone()
+        if row is None or row[0] != options:
+            self._db.execute('DELETE FROM fingerprints')
+            self._db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('options', ?)", (options,))
+        self._db.commit()
+
+    def load(self):
+        return dict(self._db.execute('SELECT key, fingerprint FROM fingerprints'))
+
+    def update(self, fingerprints):
+        self._db.executemany('INSERT OR REPLACE INTO fingerprints (key, fingerprint) VALUES (?, ?)',
+                             fingerprints.items())
+
+    def delete(self, keys):
+        self._db.executemany('DELETE FROM fingerprints WHERE key = ?', ((key,) for key in keys))
+
+    def commit(self):
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class OutputLayerSink:
+    """
+    Feature sink adding features to an existing layer through its data
+    provider. Attributes are matched by field name, and the output features
+    with the same keys are deleted before adding their new version.
+    """
+
+    def __init__(self, layer, key_field, batch_size=10000):
+        self.provider = layer.dataProvider()
+        self.fields = self.provider.fields()
+        self.key_field = key_field
+        self.batch_size = batch_size
+        self.pending_deletes = []
+        self.added = 0
+        self.deleted = 0
+
+        if layer.isEditable():
+            raise QgsProcessingException('The existing output {} must not be in edit mode to be updated'.format(
+                layer.name()))
+        capabilities = self.provider.capabilities()
+        if not (capabilities & QgsVectorDataProvider.AddFeatures and
+                capabilities & QgsVectorDataProvider.DeleteFeatures):
+            raise QgsProcessingException('The existing output {} cannot be edited'.format(layer.name()))
+
+        # Output features of every key
+        self.fids = {}
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([key_field], self.fields)
+        for feature in self.provider.getFeatures(request):
+            self.fids.setdefault(str(feature[key_field]), []).append(feature.id())
+
+    def delete(self, key):
+        """
+        Deletes the output features of a key, once the next features are
+        added or the sink is flushed.
+        """
+        self.pending_deletes.extend(self.fids.pop(key, ()))
+        if len(self.pending_deletes) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending_deletes:
+            if not self.provider.deleteFeatures(self.pending_deletes):
+                raise QgsProcessingException('Could not delete features: {}'.format(self.provider.lastError()))
+            self.deleted += len(self.pending_deletes)
+            self.pending_deletes = []
+
+    def addFeatures(self, features, flags=0):
+        self.flush()
+        mapped = []
+        for feature in features:
+            new_feature = QgsFeature(self.fields)
+            new_feature.setGeometry(feature.geometry())
+            for name, value in zip(feature.fields().names(), feature.attributes()):
+                index = self.fields.indexFromName(name)
+                if index >= 0:
+                    new_feature.setAttribute(index, value)
+            mapped.append(new_feature)
+        ok, _ = self.provider.addFeatures(mapped)
+        if not ok:
+            raise QgsProcessingException('Could not add features: {}'.format(self.provider.lastError()))
+        self.added += len(mapped)
+        return True
+
+
+def process_incrementally(source, layer, key_field, kernel, options, chunk_size, feedback, across_parts=False,
+                          metrics=None):
+    """
+    Updates ``layer``, the output of a previous run, with the input features
+    which changed since that run, and deletes the output features whose key
+    is not in the input anymore. Returns the number of skipped features.
+
+    ``options`` describes the interpolation options, all the features are
+    interpolated again if they differ from the previous run.
+    """
+    metrics = metrics or Metrics()
+    if layer.fields().indexFromName(key_field) < 0:
+        raise QgsProcessingException('The existing output has no {} field'.format(key_field))
+
+    index = FingerprintIndex(fingerprints_path(layer), options)
+    try:
+        previous = index.load()
+        sink = OutputLayerSink(layer, key_field)
+        changed = {}
+
+        def changed_features():
+            for feature in source.getFeatures():
+                if feedback.isCanceled():
+                    return
+                key = str(feature[key_field])
+                with metrics.timer('fingerprint'):
+                    new_fingerprint = fingerprint(feature)
+                if previous.pop(key, None) == new_fingerprint and key in sink.fids:
+                    # Kept as is, and not deleted with the removed keys
+                    del sink.fids[key]
+                    metrics.count('unchanged')
+                    continue
+                metrics.count('changed')
+                changed[key] = new_fingerprint
+                sink.delete(key)
+                yield feature
+                if len(changed) >= chunk_size:
+                    index.update(changed)
+                    changed.clear()
+
+        bad = interpolate_stream(
+            changed_features(), sink, kernel, chunk_size, feedback, across_parts, metrics
+        )
+        if feedback.isCanceled():
+            return bad
+        index.update(changed)
+
+        # Keys which are not in the input anymore
+        for key in list(sink.fids):
+            sink.delete(key)
+        sink.flush()
+        index.delete(previous)
+        metrics.count('deleted', sink.deleted)
+        index.commit()
+    finally:
+        index.close()
+    layer.triggerRepaint()
+    return bad
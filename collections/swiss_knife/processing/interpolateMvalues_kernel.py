@@ -0,0 +1,136 @@
+#-*- coding: utf-8 -*-
+
+"""
+***************************************************************************
+*                                                                         *
+*   This program is free software; you can redistribute it and/or modify  *
+*   it under the terms of the GNU General Public License as published by  *
+*   the Free Software Foundation; either version 2 of the License, or     *
+*   (at your option) any later version.                                   *
+*                                                                         *
+***************************************************************************
+
+M-value interpolation kernel shared by the interpolation algorithms.
+
+The kernel works on ragged arrays of plain numbers and only depends on
+numpy, the chunks are packed from and rebuilt to QGIS geometries in
+interpolateMvalues_core.
+"""
+
+import numpy as np
+
+
+# Vertices whose M-value is missing, NaN M-values are always missing
+MISSING_ZERO = 'zero'
+MISSING_NAN = 'nan'
+MISSING_BELOW = 'below'
+
+# M-values of the vertices before the first and after the last known M-value
+ENDS_KEEP = 'keep'
+ENDS_NEAREST = 'nearest'
+ENDS_LINEAR = 'linear'
+
+
+def missing_mask(m, missing=MISSING_ZERO, threshold=0.0):
+    """
+    Returns the mask of the vertices whose M-value is missing.
+    """
+    mask = np.isnan(m)
+    if missing == MISSING_ZERO:
+        mask |= m == 0
+    elif missing == MISSING_BELOW:
+        mask |= m < threshold
+    return mask
+
+
+def interpolate_masked(x, y, m, offsets, parts=None, missing=MISSING_ZERO, threshold=0.0, decimals=0,
+                       ends=ENDS_NEAREST):
+    """
+    Interpolates the missing M-values between the known M-values of every
+    line of the chunk at once, in one masked pass over float64 arrays.
+
+    Interpolated M-values are rounded to ``decimals`` decimals, or not
+    rounded if ``decimals`` is None. Vertices before the first and after
+    the last known M-value of a line are left untouched, take the nearest
+    known M-value or are extrapolated linearly from the two nearest known
+    M-values, depending on ``ends``.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    m = np.asarray(m, dtype=np.float64)
+    offsets = np.asarray(offsets)
+    count = len(m)
+    if count == 0:
+        return m
+
+    # Line start and end (inclusive) of every vertex
+    lengths = np.diff(offsets)
+    line_start = np.repeat(offsets[:-1], lengths)
+    line_end = np.repeat(offsets[1:] - 1, lengths)
+
+    # Distance along the chunk, segments joining two parts have no length
+    segments = np.hypot(np.diff(x), np.diff(y))
+    joins = np.asarray(offsets if parts is None else parts)[1:-1] - 1
+    segments[joins[(joins >= 0) & (joins < count - 1)]] = 0
+    distances = np.zeros(count)
+    np.cumsum(segments, out=distances[1:])
+
+    # Previous and next known M-value of every vertex, within its line
+    known = ~missing_mask(m, missing, threshold)
+    indices = np.arange(count)
+    previous = np.maximum.accumulate(np.where(known, indices, -1))
+    following = np.minimum.accumulate(np.where(known, indices, count)[::-1])[::-1]
+    has_previous = previous >= line_start
+    has_following = following <= line_end
+    previous = np.clip(previous, 0, count - 1)
+    following = np.clip(following, 0, count - 1)
+
+    m_interpolated = np.copy(m)
+    between = ~known & has_previous & has_following
+    before = ~known & ~has_previous & has_following
+    after = ~known & has_previous & ~has_following
+
+    p = previous[between]
+    f = following[between]
+    span = distances[f] - distances[p]
+    ratio = np.divide(distances[between] - distances[p], span, out=np.zeros(len(p)), where=span != 0)
+    m_interpolated[between] = m[p] + ratio * (m[f] - m[p])
+
+    if ends == ENDS_NEAREST:
+        m_interpolated[before] = m[following[before]]
+        m_interpolated[after] = m[previous[after]]
+    elif ends == ENDS_LINEAR:
+        # Slope between the two nearest known M-values, nearest value if
+        # there is only one
+        first = following[before]
+        second = following[np.minimum(first + 1, count - 1)]
+        # following[] can point at a vertex of a later line, previous[] at
+        # an unknown vertex where it was clipped
+        m_interpolated[before] = extrapolate(
+            m, distances, distances[before], first, second, known[second] & (second <= line_end[before])
+        )
+        last = previous[after]
+        second = previous[np.maximum(last - 1, 0)]
+        m_interpolated[after] = extrapolate(
+            m, distances, distances[after], last, second,
+            known[second] & (second < last) & (second >= line_start[after])
+        )
+    else:
+        before[:] = False
+        after[:] = False
+
+    if decimals is not None:
+        changed = between | before | after
+        m_interpolated[changed] = np.around(m_interpolated[changed], decimals=decimals)
+    return m_interpolated
+
+
+def extrapolate(m, distances, at, nearest, second, has_second):
+    """
+    Returns the M-values at the distances ``at`` on the line through the
+    known vertices ``nearest`` and ``second``, the M-value of ``nearest``
+    where there is no second vertex or both are at the same distance.
+    """
+    span = distances[second] - distances[nearest]
+    slope = np.divide(m[second] - m[nearest], span, out=np.zeros(len(nearest)), where=has_second & (span != 0))
+    return m[nearest] + slope * (at - distances[nearest])
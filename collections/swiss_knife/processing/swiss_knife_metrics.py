@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight instrumentation shared by the swiss_knife processing scripts.
+
+Algorithms collect timings of their stages, counters and latency
+histograms in a Metrics object, report them in the log and return them as
+algorithm outputs, optionally dumped to a JSON file.
+"""
+
+import bisect
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+from PyQt5.QtCore import QCoreApplication
+from qgis.core import (QgsProcessingOutputNumber,
+                       QgsProcessingOutputString,
+                       QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFileDestination)
+
+
+class Metrics:
+    """
+    Thread safe collection of stage timers, counters and histograms.
+
+    Timers accumulate the time spent in a stage and the number of times it
+    ran, stages running in worker threads add up their time. Histograms
+    count observations per bucket, the buckets of latencies are given in
+    seconds.
+    """
+
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, count=1):
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += count
+            timer[1] += seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    'buckets': list(buckets), 'counts': [0] * (len(buckets) + 1),
+                    'count': 0, 'sum': 0.0, 'min': value, 'max': value
+                }
+            histogram['counts'][bisect.bisect_left(histogram['buckets'], value)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+            histogram['min'] = min(histogram['min'], value)
+            histogram['max'] = max(histogram['max'], value)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'timers': {name: {'count': count, 'seconds': seconds}
+                           for name, (count, seconds) in self.timers.items()},
+                'counters': dict(self.counters),
+                'histograms': {name: dict(histogram, counts=list(histogram['counts']))
+                               for name, histogram in self.histograms.items()}
+            }
+
+    def report(self, feedback):
+        """
+        Pushes one line per timer, counter and histogram to the feedback.
+        """
+        metrics = self.as_dict()
+        for name, timer in metrics['timers'].items():
+            feedback.pushInfo('{}: {:.3f} s in {} calls'.format(name, timer['seconds'], timer['count']))
+        for name, value in metrics['counters'].items():
+            feedback.pushInfo('{}: {}'.format(name, value))
+        for name, histogram in metrics['histograms'].items():
+            bounds = ['<={}'.format(bound) for bound in histogram['buckets']] + ['>{}'.format(histogram['buckets'][-1])]
+            feedback.pushInfo('{}: {} observations, mean {:.3f}, min {:.3f}, max {:.3f}, {}'.format(
+                name, histogram['count'], histogram['sum'] / histogram['count'], histogram['min'],
+                histogram['max'],
+                ', '.join('{} {}'.format(bound, count)
+                          for bound, count in zip(bounds, histogram['counts']) if count)
+            ))
+
+
+class AlgorithmMetrics:
+    """
+    Mixin adding the metrics outputs of an algorithm and the optional JSON
+    file they are dumped to.
+
+    Every name of METRIC_OUTPUTS is also returned as a number output, with
+    the value of the counter of the same name in lower case.
+    """
+
+    METRICS = 'METRICS'
+    METRICS_FILE = 'METRICS_FILE'
+    METRIC_OUTPUTS = ()
+
+    def addMetricsParameters(self):
+        tr = lambda string: QCoreApplication.translate('Processing', string)  # noqa: E731
+
+        metrics_file = QgsProcessingParameterFileDestination(
+            self.METRICS_FILE,
+            tr('Metrics file'),
+            fileFilter='JSON files (*.json)',
+            optional=True,
+            createByDefault=False
+        )
+        metrics_file.setFlags(metrics_file.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(metrics_file)
+
+        self.addOutput(QgsProcessingOutputString(self.METRICS, tr('Metrics (JSON)')))
+        for name in self.METRIC_OUTPUTS:
+            self.addOutput(QgsProcessingOutputNumber(name, tr(name.replace('_', ' ').capitalize())))
+
+    def reportMetrics(self, metrics, parameters, context, feedback):
+        """
+        Reports the metrics in the log, dumps them to the metrics file if
+        set and returns the metrics outputs.
+        """
+        metrics.report(feedback)
+        dump = metrics.as_dict()
+        results = {self.METRICS: json.dumps(dump)}
+        for name in self.METRIC_OUTPUTS:
+            results[name] = dump['counters'].get(name.lower(), 0)
+
+        path = self.parameterAsFileOutput(parameters, self.METRICS_FILE, context)
+        if path:
+            with open(path, 'w') as f:
+                json.dump(dump, f, indent=2)
+            results[self.METRICS_FILE] = path
+        return results
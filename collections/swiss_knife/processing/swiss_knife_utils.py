@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+Helpers shared by the swiss_knife processing scripts: map_ordered runs a
+function over items with a thread pool and returns the results in input
+order, FeatureBatchWriter buffers the features written to a sink and adds
+them in batches.
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+
+from qgis.core import QgsFeatureSink
+
+
+def map_ordered(func, items, concurrency=1, feedback=None, total=0):
+    """
+    Calls ``func`` for every item and yields ``(item, result)`` tuples in the
+    order of ``items``.
+
+    Up to ``concurrency`` calls run at the same time in a thread pool. Items
+    are pulled lazily from the iterable, so only a bounded window of pending
+    calls is held in memory. Progress is reported on ``feedback`` when calls
+    finish (not when they are submitted) and iteration stops as soon as the
+    feedback is canceled.
+    """
+    finished = [0]
+    lock = threading.Lock()
+
+    def report():
+        if feedback is not None and total:
+            feedback.setProgress(finished[0] / total * 100)
+
+    if concurrency <= 1:
+        for item in items:
+            if feedback is not None and feedback.isCanceled():
+                return
+            result = func(item)
+            finished[0] += 1
+            report()
+            yield item, result
+        return
+
+    def done(_future):
+        with lock:
+            finished[0] += 1
+
+    window = collections.deque()
+    iterator = iter(items)
+    exhausted = False
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        while True:
+            while not exhausted and len(window) < concurrency * 2:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    exhausted = True
+                    break
+                future = executor.submit(func, item)
+                future.add_done_callback(done)
+                window.append((item, future))
+
+            if not window:
+                return
+
+            item, future = window[0]
+            while not wait([future], timeout=0.1).done:
+                report()
+                if feedback is not None and feedback.isCanceled():
+                    return
+            if feedback is not None and feedback.isCanceled():
+                return
+            report()
+            window.popleft()
+            yield item, future.result()
+    finally:
+        for _item, future in window:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+class FeatureBatchWriter:
+    """
+    Buffers features and writes them to a sink with one addFeatures call
+    per ``batch_size`` features, so only one batch is held in memory.
+    """
+
+    def __init__(self, sink, batch_size=1000):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.count = 0
+        self._batch = []
+
+    def add(self, feature):
+        self._batch.append(feature)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._batch:
+            self.sink.addFeatures(self._batch, QgsFeatureSink.FastInsert)
+            self.count += len(self._batch)
+            self._batch = []
@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+
+"""
+Access to the transport.opendata.ch API shared by the Swiss Public Transport
+algorithms: an HTTP client with retries, a shared rate limiter and a SQLite
+response cache, and the parsing of /connections responses into departure and
+arrival timestamps, durations and departure window statistics.
+"""
+
+from email.utils import parsedate_to_datetime
+import json
+import os
+import random
+import sqlite3
+import statistics
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_BASE_URL = 'http://transport.opendata.ch/v1'
+
+# Location of the response cache, relative to the QGIS settings directory
+CACHE_FILE = os.path.join('swiss_knife', 'spt_cache.sqlite')
+
+MINUTE = 60
+DAY = 24 * 60 * MINUTE
+
+# HTTP statuses worth retrying, the API throttles with 429
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Projection of /connections responses on what is needed to compute durations
+DURATION_FIELDS = ['connections/from/departureTimestamp', 'connections/to/arrivalTimestamp']
+
+# Projection of /connections responses on the details of every connection
+CONNECTION_FIELDS = DURATION_FIELDS + [
+    'connections/from/platform', 'connections/transfers', 'connections/products'
+]
+
+class SwissPublicTransportError(Exception):
+    """
+    Raised when a query cannot be answered by the API, even after retrying.
+    """
+
+
+class ResponseCache:
+    """
+    Persistent cache of API responses stored in a SQLite database.
+
+    Entries are keyed by endpoint and normalized query parameters, the
+    departure time included. Every endpoint has its own time to live.
+    The least recently used entries are evicted once the cache holds more
+    than ``max_entries`` responses.
+
+    The database is in WAL mode and hits do not write to it: their access
+    times are kept in memory and stored with the next put, eviction or on
+    close.
+    """
+
+    TTL = {
+        'locations': 30 * DAY,
+        'connections': 30 * MINUTE
+    }
+    DEFAULT_TTL = DAY
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._puts = 0
+        # Access times of the hits not stored yet, by key
+        self._accessed = {}
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, endpoint TEXT NOT NULL, content TEXT NOT NULL, '
+            'created REAL NOT NULL, accessed REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._db.commit()
+
+    def key(self, endpoint, params, base_url=DEFAULT_BASE_URL):
+        """
+        Returns the cache key of a query, parameters are normalized so that
+        equivalent queries share the same key.
+        """
+        normalized = {}
+        for name, value in params.items():
+            if isinstance(value, str):
+                value = ' '.join(value.split()).casefold()
+            normalized[name] = value
+        key = endpoint + '?' + json.dumps(sorted(normalized.items()), default=str)
+        if base_url != DEFAULT_BASE_URL:
+            key = base_url + '/' + key
+        return key
+
+    def get(self, endpoint, params, base_url=DEFAULT_BASE_URL):
+        """
+        Returns the cached content of a query or None if it is not cached or
+        expired.
+        """
+        key = self.key(endpoint, params, base_url)
+        now = time.time()
+        ttl = self.TTL.get(endpoint, self.DEFAULT_TTL)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT content, created FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or now - row[1] > ttl:
+                self.misses += 1
+                return None
+            self._accessed[key] = now
+            self.hits += 1
+            return row[0]
+
+    def put(self, endpoint, params, content, base_url=DEFAULT_BASE_URL):
+        key = self.key(endpoint, params, base_url)
+        now = time.time()
+        with self._lock:
+            self._store_accessed()
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses (key, endpoint, content, created, accessed) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (key, endpoint, content, now, now)
+            )
+            self._puts += 1
+            if self._puts % 100 == 0:
+                self._evict()
+            self._db.commit()
+
+    def _store_accessed(self):
+        if self._accessed:
+            self._db.executemany(
+                'UPDATE responses SET accessed = ? WHERE key = ?',
+                [(accessed, key) for key, accessed in self._accessed.items()]
+            )
+            self._accessed = {}
+
+    def _evict(self):
+        self._store_accessed()
+        count = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM responses ORDER BY accessed LIMIT ?)',
+                (count - self.max_entries,)
+            )
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._db.commit()
+            self._db.close()
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the rate of requests sent to the API.
+
+    Up to ``burst`` requests can be sent at once, then requests are spaced
+    to stay under ``rate`` requests per second. The limiter is thread safe.
+    """
+
+    def __init__(self, rate, burst=1):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst=1):
+        with self._lock:
+            self.rate = rate
+            self.burst = max(1, burst)
+            self._tokens = float(self.burst)
+            self._updated = time.monotonic()
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent and returns the time waited in
+        seconds.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                if self.rate <= 0:
+                    return waited
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+_shared_rate_limiter = None
+_shared_rate_limiter_lock = threading.Lock()
+
+
+def shared_rate_limiter(rate, burst=1):
+    """
+    Returns the rate limiter shared by all the algorithms of the process,
+    configured with the given rate and burst.
+    """
+    global _shared_rate_limiter
+    with _shared_rate_limiter_lock:
+        if _shared_rate_limiter is None:
+            _shared_rate_limiter = RateLimiter(rate, burst)
+        elif (_shared_rate_limiter.rate, _shared_rate_limiter.burst) != (rate, max(1, burst)):
+            _shared_rate_limiter.configure(rate, burst)
+        return _shared_rate_limiter
+
+
+def connection_timestamps(content):
+    """
+    Returns the (departure, arrival) timestamps of every connection of a
+    /connections response, None for missing timestamps.
+
+    Responses projected on DURATION_FIELDS are small, the C json decoder
+    reads them faster than scanning their text with regular expressions,
+    and unprojected responses are read the same way.
+    """
+    data = json.loads(content)
+    if not isinstance(data, dict) or not isinstance(data.get('connections'), list):
+        raise SwissPublicTransportError('Response without connections: {}'.format(content[:200]))
+    return [
+        (
+            (connection.get('from') or {}).get('departureTimestamp'),
+            (connection.get('to') or {}).get('arrivalTimestamp')
+        )
+        for connection in data['connections']
+    ]
+
+
+def connection_durations(content):
+    """
+    Returns the duration in minutes of every connection of a /connections
+    response projected on DURATION_FIELDS, None for connections without
+    timestamps.
+    """
+    return [
+        None if departure is None or arrival is None else (arrival - departure) / 60
+        for departure, arrival in connection_timestamps(content)
+    ]
+
+
+def fetch_connection_duration(client, origin, destination, date, time_of_day, fastest=False):
+    """
+    Returns the duration in minutes of the soonest connection departing at
+    ``date`` ('yyyy-MM-dd') and ``time_of_day`` ('HH:mm'), or of the
+    fastest connection returned by the request, None if there is none.
+    """
+    payload = {
+        'from': origin,
+        'to': destination,
+        'date': date,
+        'time': time_of_day,
+        'fields[]': DURATION_FIELDS
+    }
+    content = client.get_content('connections', payload)
+    start = time.perf_counter()
+    durations = [duration for duration in connection_durations(content) if duration is not None]
+    if client.metrics is not None:
+        client.metrics.add_time('parse', time.perf_counter() - start)
+    if len(durations) == 0:
+        return None
+    return min(durations) if fastest else durations[0]
+
+
+def sweep_connections(client, origin, destination, start, end, limit, is_canceled=None):
+    """
+    Returns the distinct (departure, arrival) timestamps of the connections
+    departing from ``start`` on, sorted by departure, and the number of
+    requests sent. ``start`` and ``end`` are in seconds since epoch.
+
+    Every request returns up to ``limit`` connections sorted by departure,
+    so the connections departing before the minute of the last one are all
+    known. The next request is sent for that minute, whose other
+    connections may have been cut by the limit, or for the next minute if
+    all the connections depart at the requested one. The sweep stops once
+    the requested minute is after ``end`` or a response has no connection.
+    """
+    connections = set()
+    requests = 0
+    cursor = start
+    while cursor <= end and not (is_canceled is not None and is_canceled()):
+        requested_time = time.localtime(cursor)
+        payload = {
+            'from': origin,
+            'to': destination,
+            'date': time.strftime('%Y-%m-%d', requested_time),
+            'time': time.strftime('%H:%M', requested_time),
+            'limit': limit,
+            'fields[]': DURATION_FIELDS
+        }
+        content = client.get_content('connections', payload)
+        requests += 1
+        parse_start = time.perf_counter()
+        timestamps = [
+            (departure, arrival) for departure, arrival in connection_timestamps(content)
+            if departure is not None and arrival is not None
+        ]
+        if client.metrics is not None:
+            client.metrics.add_time('parse', time.perf_counter() - parse_start)
+        if not timestamps:
+            break
+
+        connections.update(connection for connection in timestamps if connection[0] >= start)
+        last_minute = max(departure for departure, _ in timestamps)
+        last_minute -= last_minute % MINUTE
+        cursor = last_minute if last_minute > cursor else cursor - cursor % MINUTE + MINUTE
+    return sorted(connections), requests
+
+
+def connection_statistics(connections, start, end, interval):
+    """
+    Returns the statistics of a sweep between ``start`` and ``end``
+    (seconds since epoch) of the connections returned by
+    sweep_connections: the number of connections departing in the window
+    and their frequency per hour, and the minimum, median and maximum
+    duration in minutes of the soonest connection of every departure time
+    spaced by ``interval`` seconds.
+    """
+    durations = []
+    index = 0
+    for slot in range(start, end + 1, interval):
+        while index < len(connections) and connections[index][0] < slot:
+            index += 1
+        if index == len(connections):
+            break
+        departure, arrival = connections[index]
+        durations.append((arrival - departure) / 60)
+
+    count = sum(1 for departure, _ in connections if departure <= end)
+    result = {'count': count}
+    if end > start:
+        result['frequency'] = count * 3600 / (end - start)
+    if durations:
+        result['min'] = min(durations)
+        result['median'] = statistics.median(durations)
+        result['max'] = max(durations)
+    return result
+
+
+def connection_summaries(data):
+    """
+    Returns the departure and arrival timestamps, duration in minutes,
+    number of transfers, products and departure platform of every
+    connection of a decoded /connections response.
+    """
+    summaries = []
+    for connection in data['connections']:
+        departure = connection['from'].get('departureTimestamp')
+        arrival = connection['to'].get('arrivalTimestamp')
+        summaries.append({
+            'departure': departure,
+            'arrival': arrival,
+            'duration': None if departure is None or arrival is None else (arrival - departure) / 60,
+            'transfers': connection.get('transfers'),
+            'products': ', '.join(product for product in connection.get('products') or [] if product),
+            'platform': connection['from'].get('platform')
+        })
+    return summaries
+
+
+def create_session(headers=None, pool_size=10):
+    """
+    Returns a requests session keeping up to ``pool_size`` connections
+    alive and accepting compressed responses.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+    session.headers.update(headers or {})
+    return session
+
+
+def retry_after(resp):
+    """
+    Returns the delay in seconds requested by the Retry-After header of a
+    response, or None.
+    """
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class SwissPublicTransportClient:
+    """
+    Client of the transport.opendata.ch API, optionally backed by a
+    ResponseCache and throttled by a RateLimiter.
+
+    Requests go through a pooled session. Connection errors, timeouts and
+    throttled or failing responses are retried with exponential backoff and
+    jitter, honouring the Retry-After header sent by the server.
+
+    If ``metrics`` is given, request latencies, retries, cache hits and the
+    time waited on the rate limiter are recorded in it.
+    """
+
+    def __init__(self, headers=None, base_url=DEFAULT_BASE_URL, cache=None, session=None,
+                 rate_limiter=None, timeout=30, max_retries=5, backoff=0.5, max_backoff=60, metrics=None):
+        self.base_url = base_url.rstrip('/') or DEFAULT_BASE_URL
+        self.cache = cache
+        self.metrics = metrics
+        self.rate_limiter = rate_limiter
+        self.rate_limit_wait = 0.0
+        self._lock = threading.Lock()
+        self.session = session or create_session(headers)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def get(self, endpoint, params):
+        """
+        Queries an endpoint (e.g. 'locations' or 'connections') and returns
+        the decoded JSON response. Raises SwissPublicTransportError if the
+        query fails.
+        """
+        content = self.get_content(endpoint, params)
+        try:
+            return json.loads(content)
+        except ValueError as e:
+            raise SwissPublicTransportError(
+                'Query {} {} returned an invalid response: {}'.format(endpoint, params, e)
+            )
+
+    def get_content(self, endpoint, params):
+        """
+        Queries an endpoint and returns the raw JSON text of the response.
+        Raises SwissPublicTransportError if the query fails.
+        """
+        if self.cache is not None:
+            content = self.cache.get(endpoint, params, self.base_url)
+            if content is not None:
+                if self.metrics is not None:
+                    self.metrics.count('cache_hits')
+                return content
+
+        url = '{}/{}'.format(self.base_url, endpoint)
+        for attempt in range(self.max_retries + 1):
+            delay = None
+            if self.rate_limiter is not None:
+                waited = self.rate_limiter.acquire()
+                with self._lock:
+                    self.rate_limit_wait += waited
+                if self.metrics is not None:
+                    self.metrics.add_time('rate_limit_wait', waited)
+            start = time.perf_counter()
+            try:
+                resp = self.session.get(url, params=params, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = str(e)
+                if self.metrics is not None:
+                    self.metrics.count('connection_errors')
+            else:
+                if self.metrics is not None:
+                    self.metrics.observe('{}_latency'.format(endpoint), time.perf_counter() - start)
+                    self.metrics.count('requests')
+                if resp.status_code not in RETRY_STATUSES:
+                    break
+                error = '{} {}'.format(resp.status_code, resp.reason)
+                delay = retry_after(resp)
+
+            if attempt == self.max_retries:
+                raise SwissPublicTransportError(
+                    'Query {} {} failed after {} attempts: {}'.format(endpoint, params, attempt + 1, error)
+                )
+            if self.metrics is not None:
+                self.metrics.count('retries')
+            if delay is None:
+                delay = self.backoff * 2 ** attempt
+                delay += random.uniform(0, delay)
+            time.sleep(min(delay, self.max_backoff))
+
+        if not resp.ok:
+            raise SwissPublicTransportError(
+                'Query {} {} failed: {} {}'.format(endpoint, params, resp.status_code, resp.reason)
+            )
+        content = resp.text
+        if self.cache is not None:
+            self.cache.put(endpoint, params, content, self.base_url)
+        return content
+
+    def close(self, feedback=None):
+        self.session.close()
+        if self.rate_limiter is not None and feedback is not None:
+            feedback.pushInfo('Waited {:.1f} s on the rate limiter'.format(self.rate_limit_wait))
+        if self.cache is not None:
+            if feedback is not None:
+                feedback.pushInfo(
+                    'Response cache: {} hits, {} misses'.format(self.cache.hits, self.cache.misses)
+                )
+            self.cache.close()
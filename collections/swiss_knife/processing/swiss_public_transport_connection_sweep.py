@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+from PyQt5.QtCore import QCoreApplication, QVariant, QDateTime
+from qgis.core import (
+    QgsVectorLayer,
+    QgsFeature, QgsField, QgsFields,
+    QgsProcessingAlgorithm,
+    QgsProcessing,
+    QgsFeatureRequest,
+    QgsProcessingMultiStepFeedback,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterDateTime,
+    QgsProcessingParameterField,
+    QgsProcessingFeatureSource,
+    QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterNumber,
+    NULL
+)
+
+sys.path.insert(0, os.path.dirname(__file__))
+from swiss_knife_metrics import AlgorithmMetrics, Metrics  # noqa: E402
+from swiss_public_transport_parameters import SwissPublicTransportClientParameters  # noqa: E402
+from swiss_public_transport_api import (  # noqa: E402
+    SwissPublicTransportError,
+    connection_statistics, sweep_connections
+)
+
+
+class SwissPublicTransportConnectionSweep(
+        AlgorithmMetrics, SwissPublicTransportClientParameters, QgsProcessingAlgorithm):
+
+    FAILED = 'FAILED'
+    METRIC_OUTPUTS = (FAILED,)
+
+    INPUT_LAYER = 'INPUT_LAYER'
+    FROM_FIELD = 'FROM_FIELD'
+    TO_FIELD = 'TO_FIELD'
+    START = 'START'
+    END = 'END'
+    INTERVAL = 'INTERVAL'
+    CONNECTIONS_PER_REQUEST = 'CONNECTIONS_PER_REQUEST'
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return SwissPublicTransportConnectionSweep()
+
+    def group(self):
+        return self.tr('Swiss Public Transport API')
+
+    def groupId(self):
+        return 'SwissPublicTransportAPI'
+
+    def __init__(self):
+        super().__init__()
+
+    def initAlgorithm(self, config):
+
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.INPUT_LAYER,
+                self.tr("Input layer"),
+                [QgsProcessing.TypeVector]
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.FROM_FIELD,
+                self.tr('From'),
+                parentLayerParameterName=self.INPUT_LAYER,
+                type=QgsProcessingParameterField.String
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.TO_FIELD,
+                self.tr('To'),
+                parentLayerParameterName=self.INPUT_LAYER,
+                type=QgsProcessingParameterField.String
+            )
+        )
+
+        now = QDateTime.currentDateTime()
+        self.addParameter(
+            QgsProcessingParameterDateTime(
+                self.START,
+                self.tr('Start of the departure window'),
+                type=QgsProcessingParameterDateTime.Type.DateTime,
+                defaultValue=now
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterDateTime(
+                self.END,
+                self.tr('End of the departure window'),
+                type=QgsProcessingParameterDateTime.Type.DateTime,
+                defaultValue=now.addSecs(3 * 3600)
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.INTERVAL,
+                self.tr('Departure interval (minutes)'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=10
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CONNECTIONS_PER_REQUEST,
+                self.tr('Connections per request'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                maxValue=16,
+                defaultValue=6
+            )
+        )
+
+        self.addClientParameters()
+
+        self.addMetricsParameters()
+
+        # Define output parameters
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                "OUTPUT", self.tr("Swiss Public Transport Connection Sweep"), type=QgsProcessing.TypeVector
+            )
+        )
+
+    def name(self):
+        return 'spt-getconnectionsweep'
+
+    def displayName(self):
+        return self.tr('Get Connection Sweep')
+
+    def shortHelpString(self):
+        return self.tr(
+            'Computes travel time statistics of every (from, to) pair over a departure window.\n'
+            'For every departure time between the start and the end of the window, spaced by the '
+            'interval, the soonest connection is looked up and the minimum, median and maximum '
+            'of their durations (in minutes) are returned, together with the number of distinct '
+            'connections departing in the window and their frequency per hour.\n'
+            'Every request returns several connections, the next request starts at the minute of '
+            'the last returned departure, so all the connections departing in the window are '
+            'found without requesting every departure time.'
+        )
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        self.headers = {'User-Agent': 'qgis/opengis.ch'}
+
+        self.metrics = Metrics()
+        self.client = self.createClient(parameters, context, self.headers, self.metrics)
+        return True
+
+    def sourceFlags(self):
+        return QgsProcessingFeatureSource.FlagSkipGeometryValidityChecks
+
+    def processAlgorithm(self, parameters, context, feedback):
+
+        input_layer: QgsVectorLayer = self.parameterAsLayer(parameters, self.INPUT_LAYER, context)
+        from_field = self.parameterAsString(parameters, self.FROM_FIELD, context)
+        to_field = self.parameterAsString(parameters, self.TO_FIELD, context)
+        start = self.parameterAsDateTime(parameters, self.START, context).toSecsSinceEpoch()
+        end = self.parameterAsDateTime(parameters, self.END, context).toSecsSinceEpoch()
+        interval = self.parameterAsInt(parameters, self.INTERVAL, context) * 60
+        limit = self.parameterAsInt(parameters, self.CONNECTIONS_PER_REQUEST, context)
+
+        if end < start:
+            feedback.reportError(self.tr('The end of the departure window is before its start'), True)
+            self.client.close()
+            return {}
+
+        output_fields = QgsFields(input_layer.fields())
+        output_fields.append(QgsField('spt_min', QVariant.Double, "double"))
+        output_fields.append(QgsField('spt_median', QVariant.Double, "double"))
+        output_fields.append(QgsField('spt_max', QVariant.Double, "double"))
+        output_fields.append(QgsField('spt_count', QVariant.Int, "int"))
+        output_fields.append(QgsField('spt_frequency', QVariant.Double, "double"))
+        output_fields.append(QgsField('spt_requests', QVariant.Int, "int"))
+
+        (sink, sink_id) = self.parameterAsSink(
+            parameters, "OUTPUT", context, output_fields,
+            input_layer.wkbType(), input_layer.crs()
+        )
+
+        def pair_of(feature):
+            return tuple(
+                None if value == NULL else value
+                for value in (feature[from_field], feature[to_field])
+            )
+
+        # First pass: collect the distinct (from, to) pairs, reading only
+        # the two fields without geometries
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([from_field, to_field], input_layer.fields())
+        pairs, feature_count = self.readDistinct(input_layer, request, pair_of, feedback)
+        if pairs is None:
+            return {}
+
+        def fetch(pair):
+            if None in pair:
+                self.metrics.count('skipped')
+                return {}
+            try:
+                connections, requests = sweep_connections(
+                    self.client, pair[0], pair[1], start, end, limit, feedback.isCanceled
+                )
+                row = connection_statistics(connections, start, end, interval)
+            except (SwissPublicTransportError, KeyError, ValueError) as e:
+                failures.append(self.tr('No connection for {}: {!r}').format(pair, e))
+                return {}
+            row = {'spt_' + name: value for name, value in row.items()}
+            row['spt_requests'] = requests
+            return row
+
+        # Failed queries get null outputs
+        failures = []
+
+        # Every distinct pair is swept once, pairs are swept concurrently
+        slot_count = len(range(start, end + 1, interval))
+        feedback.pushInfo(
+            self.tr('{} distinct connections to sweep over {} departure times').format(len(pairs), slot_count)
+        )
+        multi_feedback = QgsProcessingMultiStepFeedback(2, feedback)
+        if not self.fetchDistinct(pairs, fetch, failures, parameters, context, multi_feedback):
+            return {}
+        requests = sum(row.get('spt_requests', 0) for row in pairs.values() if row)
+        feedback.pushInfo(
+            self.tr('{} requests instead of {} for one request per departure time').format(
+                requests, slot_count * sum(1 for pair in pairs if None not in pair)
+            )
+        )
+
+        output_names = [field.name() for field in output_fields][len(input_layer.fields()):]
+
+        def features_of(feature):
+            row = pairs[pair_of(feature)] or {}
+            new_feature = QgsFeature(output_fields)
+            new_feature.setGeometry(feature.geometry())
+            new_feature.setAttributes(feature.attributes() + [row.get(name) for name in output_names])
+            return [new_feature]
+
+        # Second pass: fan the statistics out to all features
+        multi_feedback.setCurrentStep(1)
+        if not self.writeFanOut(input_layer, sink, features_of, feature_count, multi_feedback):
+            return {}
+
+        results = {"OUTPUT": sink_id}
+        results.update(self.reportMetrics(self.metrics, parameters, context, feedback))
+        return results
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline station gazetteer used by the Swiss Public Transport algorithms.
+
+Stations (id, name, coordinate) are stored in a SQLite database filled from
+the stations returned by the API and from bulk imports of station lists,
+e.g. the service points published on opentransportdata.swiss. Lookups run
+against an in-memory index of normalized names, with a fuzzy fallback on
+name trigrams.
+"""
+
+import collections
+import csv
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# Location of the gazetteer, relative to the QGIS settings directory
+GAZETTEER_FILE = os.path.join('swiss_knife', 'spt_stations.sqlite')
+
+# Accepted column names of bulk imports, compared case insensitively
+IMPORT_COLUMNS = {
+    'id': ('id', 'number', 'sloid', 'dst-nr', 'didok', 'uic'),
+    'name': ('name', 'designationofficial', 'designation', 'stationname'),
+    'lon': ('lon', 'longitude', 'wgs84east', 'e_wgs84', 'x'),
+    'lat': ('lat', 'latitude', 'wgs84north', 'n_wgs84', 'y')
+}
+
+SEPARATORS_RE = re.compile(r'[\W_]+')
+
+
+def normalize_name(name):
+    """
+    Returns a station name without case, accents and punctuation, so that
+    e.g. "Zürich HB" and "zurich, hb" are the same.
+    """
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(SEPARATORS_RE.sub(' ', stripped).split())
+
+
+def trigrams(normalized):
+    padded = '  {} '.format(normalized)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class StationGazetteer:
+    """
+    Persistent station index stored in a SQLite database.
+
+    ``lookup`` returns stations in the shape of the /locations API, whose
+    coordinate x is the latitude and y the longitude, so that they can be
+    used in place of API results.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = None
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS stations ('
+            'id TEXT PRIMARY KEY, name TEXT NOT NULL, normalized TEXT NOT NULL, '
+            'lat REAL NOT NULL, lon REAL NOT NULL, updated REAL NOT NULL)'
+        )
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM stations').fetchone()[0]
+
+    def add(self, stations):
+        """
+        Adds or refreshes stations given in the shape of the /locations API,
+        stations without id or coordinate are ignored. Returns the number
+        of stored stations.
+        """
+        rows = []
+        now = time.time()
+        for station in stations:
+            coordinate = station.get('coordinate') or {}
+            if not station.get('id') or not station.get('name') or not coordinate.get('x') or not coordinate.get('y'):
+                continue
+            rows.append((
+                str(station['id']), station['name'], normalize_name(station['name']),
+                coordinate['x'], coordinate['y'], now
+            ))
+        self._store(rows)
+        return len(rows)
+
+    def import_file(self, path):
+        """
+        Imports a delimited text file with a header row holding the id, name
+        and WGS84 longitude and latitude of every station. Returns the
+        number of stored stations.
+        """
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            sample = f.read(65536)
+            f.seek(0)
+            dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+            reader = csv.reader(f, dialect)
+            header = [name.strip().casefold() for name in next(reader)]
+            columns = {}
+            for key, aliases in IMPORT_COLUMNS.items():
+                matches = [header.index(alias) for alias in aliases if alias in header]
+                if not matches:
+                    raise ValueError('No {} column in {}, expected one of {}'.format(key, path, ', '.join(aliases)))
+                columns[key] = matches[0]
+
+            rows = []
+            now = time.time()
+            for record in reader:
+                try:
+                    station_id = record[columns['id']].strip()
+                    name = record[columns['name']].strip()
+                    lon = float(record[columns['lon']])
+                    lat = float(record[columns['lat']])
+                except (IndexError, ValueError):
+                    continue
+                if station_id and name:
+                    rows.append((station_id, name, normalize_name(name), lat, lon, now))
+        self._store(rows)
+        return len(rows)
+
+    def _store(self, rows):
+        if not rows:
+            return
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO stations (id, name, normalized, lat, lon, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            self._db.commit()
+            self._index = None
+
+    def load(self):
+        """
+        Builds the in-memory name index, lookups build it on first use.
+        """
+        with self._lock:
+            if self._index is not None:
+                return
+            stations = []
+            exact = {}
+            postings = collections.defaultdict(list)
+            for station_id, name, normalized, lat, lon in self._db.execute(
+                    'SELECT id, name, normalized, lat, lon FROM stations ORDER BY updated DESC'):
+                position = len(stations)
+                stations.append(({'id': station_id, 'name': name, 'coordinate': {'x': lat, 'y': lon}},
+                                 len(trigrams(normalized))))
+                exact.setdefault(normalized, position)
+                for trigram in trigrams(normalized):
+                    postings[trigram].append(position)
+            self._index = (stations, exact, postings)
+
+    def stations(self):
+        """
+        Returns all the stations of the gazetteer.
+        """
+        self.load()
+        return [station for station, _ in self._index[0]]
+
+    def lookup(self, query, min_similarity=0.8):
+        """
+        Returns the station whose name matches the query, or None.
+
+        Names are first matched exactly once normalized, then by the
+        similarity (Dice coefficient) of their trigrams, the most similar
+        station is returned if its similarity is at least
+        ``min_similarity``. Thread safe once the index is loaded.
+        """
+        self.load()
+        stations, exact, postings = self._index
+        normalized = normalize_name(query)
+        if normalized in exact:
+            return stations[exact[normalized]][0]
+        if min_similarity >= 1:
+            return None
+
+        query_trigrams = trigrams(normalized)
+        shared = collections.Counter()
+        for trigram in query_trigrams:
+            shared.update(postings.get(trigram, ()))
+        best, best_similarity = None, 0
+        for position, count in shared.items():
+            similarity = 2 * count / (len(query_trigrams) + stations[position][1])
+            if similarity >= min_similarity and similarity > best_similarity:
+                best, best_similarity = position, similarity
+        return None if best is None else stations[best][0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
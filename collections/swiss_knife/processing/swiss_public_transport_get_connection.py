@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
-import requests
-import json
+import os
+import sys
 
 from PyQt5.QtCore import QCoreApplication, QVariant, QDateTime
 from qgis.core import (
@@ -10,28 +10,68 @@ from qgis.core import (
     QgsCoordinateReferenceSystem,
     QgsProcessingAlgorithm,
     QgsProcessing,
-    QgsFeatureSink,
+    QgsFeatureRequest,
+    QgsProcessingMultiStepFeedback,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterEnum,
     QgsProcessingParameterDateTime,
     QgsProcessingParameterField,
     QgsProcessingFeatureSource,
-    QgsProcessingParameterVectorLayer
+    QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterExpression,
+    QgsProcessingException,
+    QgsExpression,
+    QgsExpressionContextUtils,
+    QgsGeometry,
+    QgsPointXY,
+    QgsCsException,
+    QgsApplication,
+    NULL
 )
 
+sys.path.insert(0, os.path.dirname(__file__))
+from swiss_knife_metrics import AlgorithmMetrics, Metrics  # noqa: E402
+from swiss_knife_utils import map_ordered  # noqa: E402
+from swiss_public_transport_parameters import SwissPublicTransportClientParameters  # noqa: E402
+from swiss_public_transport_api import (  # noqa: E402
+    SwissPublicTransportError,
+    CONNECTION_FIELDS, connection_summaries, fetch_connection_duration
+)
+from swiss_public_transport_gazetteer import GAZETTEER_FILE, StationGazetteer  # noqa: E402
+from swiss_public_transport_snapping import StationSnapper  # noqa: E402
+
+
+class SwissPublicTransportGetConnection(
+        AlgorithmMetrics, SwissPublicTransportClientParameters, QgsProcessingAlgorithm):
 
-class SwissPublicTransportGetConnection(QgsProcessingAlgorithm):
+    FAILED = 'FAILED'
+    METRIC_OUTPUTS = (FAILED,)
 
     INPUT_LAYER = 'INPUT_LAYER'
+    INPUT_MODE = 'INPUT_MODE'
     FROM_FIELD = 'FROM_FIELD'
     TO_FIELD = 'TO_FIELD'
+    FROM_POINT = 'FROM_POINT'
+    TO_POINT = 'TO_POINT'
+    SNAP_DISTANCE = 'SNAP_DISTANCE'
     METHOD = 'METHOD'
     DATE_TIME = 'DATE_TIME'
+    OUTPUT_MODE = 'OUTPUT_MODE'
+    MAX_CONNECTIONS = 'MAX_CONNECTIONS'
 
     SOONEST = 'SOONEST'
     FASTEST = 'FASTEST'
     METHODS = [SOONEST, FASTEST]
 
+    SELECTED = 'SELECTED'
+    ALL = 'ALL'
+    OUTPUT_MODES = [SELECTED, ALL]
+
+    NAMES = 'NAMES'
+    POINTS = 'POINTS'
+    INPUT_MODES = [NAMES, POINTS]
+
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
 
@@ -56,12 +96,24 @@ class SwissPublicTransportGetConnection(QgsProcessingAlgorithm):
                 [QgsProcessing.TypeVector]
             )
         )
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.INPUT_MODE,
+                self.tr("Origins and destinations"),
+                options=[
+                    self.tr('Station names or ids'),
+                    self.tr('Points, snapped to the nearest station')
+                ],
+                defaultValue=0
+            )
+        )
         self.addParameter(
             QgsProcessingParameterField(
                 self.FROM_FIELD,
                 self.tr('From'),
                 parentLayerParameterName=self.INPUT_LAYER,
-                type=QgsProcessingParameterField.String
+                type=QgsProcessingParameterField.String,
+                optional=True
             )
         )
         self.addParameter(
@@ -69,7 +121,34 @@ class SwissPublicTransportGetConnection(QgsProcessingAlgorithm):
                 self.TO_FIELD,
                 self.tr('To'),
                 parentLayerParameterName=self.INPUT_LAYER,
-                type=QgsProcessingParameterField.String
+                type=QgsProcessingParameterField.String,
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterExpression(
+                self.FROM_POINT,
+                self.tr('From point'),
+                defaultValue='$geometry',
+                parentLayerParameterName=self.INPUT_LAYER,
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterExpression(
+                self.TO_POINT,
+                self.tr('To point'),
+                parentLayerParameterName=self.INPUT_LAYER,
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.SNAP_DISTANCE,
+                self.tr('Maximum distance to a station in the gazetteer (meters)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=500
             )
         )
 
@@ -88,6 +167,33 @@ class SwissPublicTransportGetConnection(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OUTPUT_MODE,
+                self.tr("Output rows"),
+                options=[
+                    self.tr('One row per feature with the returned result duration'),
+                    self.tr('One row per connection, ordered by the returned result')
+                ],
+                defaultValue=0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MAX_CONNECTIONS,
+                self.tr('Maximum number of connections per feature'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                maxValue=16,
+                defaultValue=4
+            )
+        )
+
+        self.addClientParameters()
+
+        self.addMetricsParameters()
+
         # Define output parameters
         self.addParameter(
             QgsProcessingParameterFeatureSink(
@@ -101,8 +207,22 @@ class SwissPublicTransportGetConnection(QgsProcessingAlgorithm):
     def displayName(self):
         return self.tr('Get Connection')
 
+    def shortHelpString(self):
+        return self.tr(
+            'Looks up the connections between the origin and destination of every feature.\n'
+            'Origins and destinations are either station names or ids read from two fields, or '
+            'points computed by two expressions, in the CRS of the input layer, e.g. $geometry '
+            'or make_point("to_x", "to_y"). Points are snapped to the nearest station of the '
+            'local station gazetteer (see Get Location from name) within the maximum distance, '
+            'points without any station nearby are resolved by the API. The connections are '
+            'then requested by station id, the ids are written in spt_from_id and spt_to_id.'
+        )
+
     def prepareAlgorithm(self, parameters, context, feedback):
         self.headers = {'User-Agent': 'qgis/opengis.ch'}
+
+        self.metrics = Metrics()
+        self.client = self.createClient(parameters, context, self.headers, self.metrics)
         return True
 
     def sourceFlags(self):
@@ -111,59 +231,244 @@ class SwissPublicTransportGetConnection(QgsProcessingAlgorithm):
     def processAlgorithm(self, parameters, context, feedback):
 
         input_layer: QgsVectorLayer = self.parameterAsLayer(parameters, self.INPUT_LAYER, context)
-        from_field = self.parameterAsString(parameters, self.FROM_FIELD, context)
-        to_field = self.parameterAsString(parameters, self.TO_FIELD, context)
+        input_mode = self.INPUT_MODES[self.parameterAsEnum(parameters, self.INPUT_MODE, context)]
         date_time: QDateTime = self.parameterAsDateTime(parameters, self.DATE_TIME, context)
+        # Both output modes request the wall clock time of the parameter
+        date = date_time.date().toString('yyyy-MM-dd')
+        time_of_day = date_time.time().toString('HH:mm')
         method = self.METHODS[self.parameterAsEnum(parameters, self.METHOD, context)]
+        output_mode = self.OUTPUT_MODES[self.parameterAsEnum(parameters, self.OUTPUT_MODE, context)]
+        max_connections = self.parameterAsInt(parameters, self.MAX_CONNECTIONS, context)
 
         output_fields = QgsFields(input_layer.fields())
         output_fields.append(QgsField('spt_duration', QVariant.Double, "double"))
+        if output_mode == self.ALL:
+            output_fields.append(QgsField('spt_rank', QVariant.Int, "int"))
+            output_fields.append(QgsField('spt_departure', QVariant.DateTime, "datetime"))
+            output_fields.append(QgsField('spt_arrival', QVariant.DateTime, "datetime"))
+            output_fields.append(QgsField('spt_transfers', QVariant.Int, "int"))
+            output_fields.append(QgsField('spt_products', QVariant.String, "text"))
+            output_fields.append(QgsField('spt_platform', QVariant.String, "text"))
+        if input_mode == self.POINTS:
+            output_fields.append(QgsField('spt_from_id', QVariant.String, "text"))
+            output_fields.append(QgsField('spt_to_id', QVariant.String, "text"))
 
         (sink, sink_id) = self.parameterAsSink(
             parameters, "OUTPUT", context, output_fields,
             input_layer.wkbType(), input_layer.crs()
         )
 
-        feature_count = input_layer.featureCount()
-        progress = 0
-
-        for feature in input_layer.getFeatures():
-            feedback.setProgress(progress/feature_count*100)
-            progress += 1
+        expression_context = self.createExpressionContext(parameters, context)
+        expression_context.appendScope(QgsExpressionContextUtils.layerScope(input_layer))
+
+        if input_mode == self.NAMES:
+            from_field = self.parameterAsString(parameters, self.FROM_FIELD, context)
+            to_field = self.parameterAsString(parameters, self.TO_FIELD, context)
+            if not from_field or not to_field:
+                self.client.close()
+                raise QgsProcessingException(self.tr('From and To fields are required with station names'))
+
+            def ends_of(feature, expression_context=None):
+                return tuple(
+                    None if value == NULL else value
+                    for value in (feature[from_field], feature[to_field])
+                )
+
+            request = QgsFeatureRequest()
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setSubsetOfAttributes([from_field, to_field], input_layer.fields())
+        else:
+            expressions = []
+            for name in (self.FROM_POINT, self.TO_POINT):
+                expression = QgsExpression(self.parameterAsExpression(parameters, name, context))
+                if not expression.expression() or expression.hasParserError():
+                    self.client.close()
+                    raise QgsProcessingException(
+                        self.tr('Invalid point expression {!r}: {}').format(
+                            expression.expression(), expression.parserErrorString()
+                        )
+                    )
+                expressions.append(expression)
+
+            def point_of(expression, expression_context):
+                geometry = expression.evaluate(expression_context)
+                if not isinstance(geometry, QgsGeometry) or geometry.isEmpty():
+                    return None
+                point = geometry.centroid().asPoint()
+                return point.x(), point.y()
+
+            def ends_of(feature, expression_context):
+                expression_context.setFeature(feature)
+                return tuple(point_of(expression, expression_context) for expression in expressions)
+
+            # Only read what the expressions use
+            request = QgsFeatureRequest()
+            columns = set()
+            for expression in expressions:
+                expression.prepare(expression_context)
+                columns.update(expression.referencedColumns())
+            if QgsFeatureRequest.ALL_ATTRIBUTES not in columns:
+                request.setSubsetOfAttributes(list(columns), input_layer.fields())
+            if not any(expression.needsGeometry() for expression in expressions):
+                request.setFlags(QgsFeatureRequest.NoGeometry)
+
+        # First pass: collect the distinct (from, to) pairs, reading only
+        # the fields and geometries they are made of
+        pairs, feature_count = self.readDistinct(
+            input_layer, request, lambda feature: ends_of(feature, expression_context), feedback
+        )
+        if pairs is None:
+            return {}
+
+        # Steps: snapping points to stations if needed, fetching, writing
+        write_step = 2 if input_mode == self.POINTS else 1
+        multi_feedback = QgsProcessingMultiStepFeedback(write_step + 1, feedback)
+        if input_mode == self.POINTS:
+            # Points are snapped to stations, connections are requested by
+            # station id
+            stations = self.snap_points(
+                {point for pair in pairs for point in pair if point is not None},
+                input_layer.crs(), parameters, context, multi_feedback
+            )
+            if feedback.isCanceled():
+                self.client.close()
+                return {}
+            multi_feedback.setCurrentStep(1)
+
+            def pair_of(feature):
+                return tuple(None if point is None else stations.get(point)
+                             for point in ends_of(feature, expression_context))
+
+            pairs = {
+                tuple(None if point is None else stations.get(point) for point in pair): None
+                for pair in pairs
+            }
+        else:
+            def pair_of(feature):
+                return ends_of(feature, expression_context)
+
+        def fetch_duration(pair):
+            duration = fetch_connection_duration(
+                self.client, pair[0], pair[1], date, time_of_day,
+                method == self.FASTEST
+            )
+            return [] if duration is None else [{'spt_duration': duration}]
 
+        def fetch_connections(pair):
             payload = {
-                'from': feature[from_field],
-                'to': feature[to_field],
-                'date': date_time.date().toString('yyyy-MM-dd'),
-                'time': date_time.time().toString('HH:mm')
+                'from': pair[0],
+                'to': pair[1],
+                'date': date,
+                'time': time_of_day,
+                'limit': max_connections,
+                'fields[]': CONNECTION_FIELDS
             }
-            url = 'http://transport.opendata.ch/v1/connections'
-            resp = requests.get(url, params=payload, headers=self.headers)
-            connections = json.loads(resp.content)['connections']
-
-            new_feature = QgsFeature(output_fields)
-            new_feature.setGeometry(feature.geometry())
+            data = self.client.get('connections', payload)
+            with self.metrics.timer('parse'):
+                summaries = connection_summaries(data)
 
-            # Clone the existing attributes
-            for i in range(len(input_layer.fields())):
-                new_feature.setAttribute(i, feature.attribute(i))
-
-            if len(connections) == 0:
-                pass
+            summaries = [summary for summary in summaries if summary['duration'] is not None]
+            if method == self.SOONEST:
+                summaries.sort(key=lambda summary: summary['departure'])
             else:
-                index = 0
-                duration = 9999999
-                if method == self.SOONEST:
-                    index = 0
-                    duration = (connections[0]['to']['arrivalTimestamp']-connections[0]['from']['departureTimestamp'])/60  # in minutes
-                else:
-                    for i in range(len(connections)):
-                        new_duration = (connections[i]['to']['arrivalTimestamp']-connections[i]['from']['departureTimestamp'])/60  # in minutes
-                        if new_duration < duration:
-                            duration = new_duration
-                            index = i
-                new_feature['spt_duration'] = duration
-
-            sink.addFeature(new_feature, QgsFeatureSink.FastInsert)
-
-        return {"OUTPUT": sink_id}
+                summaries.sort(key=lambda summary: summary['duration'])
+            return [
+                {
+                    'spt_duration': summary['duration'],
+                    'spt_rank': rank,
+                    'spt_departure': QDateTime.fromSecsSinceEpoch(summary['departure']),
+                    'spt_arrival': QDateTime.fromSecsSinceEpoch(summary['arrival']),
+                    'spt_transfers': summary['transfers'],
+                    'spt_products': summary['products'],
+                    'spt_platform': summary['platform']
+                }
+                for rank, summary in enumerate(summaries[:max_connections], 1)
+            ]
+
+        def fetch(pair):
+            if None in pair:
+                self.metrics.count('skipped')
+                return []
+            try:
+                if output_mode == self.ALL:
+                    return fetch_connections(pair)
+                return fetch_duration(pair)
+            except (SwissPublicTransportError, KeyError, ValueError) as e:
+                failures.append(self.tr('No connection for {}: {!r}').format(pair, e))
+                return []
+
+        # Failed queries get null outputs
+        failures = []
+
+        # Every distinct pair is fetched once, requests run concurrently
+        feedback.pushInfo(self.tr('{} distinct connections to query').format(len(pairs)))
+        if not self.fetchDistinct(pairs, fetch, failures, parameters, context, multi_feedback):
+            return {}
+
+        output_names = [field.name() for field in output_fields][len(input_layer.fields()):]
+
+        def features_of(feature):
+            attributes = feature.attributes()
+            pair = pair_of(feature)
+            new_features = []
+            for row in pairs[pair] or [{}]:
+                if input_mode == self.POINTS:
+                    row = dict(row, spt_from_id=pair[0], spt_to_id=pair[1])
+                new_feature = QgsFeature(output_fields)
+                new_feature.setGeometry(feature.geometry())
+                new_feature.setAttributes(attributes + [row.get(name) for name in output_names])
+                new_features.append(new_feature)
+            return new_features
+
+        # Second pass: fan the results out to all features, features without
+        # any connection are kept with null outputs
+        multi_feedback.setCurrentStep(write_step)
+        if not self.writeFanOut(input_layer, sink, features_of, feature_count, multi_feedback):
+            return {}
+
+        results = {"OUTPUT": sink_id}
+        results.update(self.reportMetrics(self.metrics, parameters, context, feedback))
+        return results
+
+    def snap_points(self, points, crs, parameters, context, feedback):
+        """
+        Returns the id of the station nearest to every point, given as (x, y)
+        tuples in the CRS of the input layer. Stations are looked up in the
+        gazetteer, points without any station nearby are resolved by the
+        API and the returned stations are stored in the gazetteer.
+        """
+        gazetteer = StationGazetteer(os.path.join(QgsApplication.qgisSettingsDirPath(), GAZETTEER_FILE))
+        snapper = StationSnapper(
+            gazetteer.stations(), crs, context.transformContext(),
+            self.parameterAsDouble(parameters, self.SNAP_DISTANCE, context)
+        )
+        feedback.pushInfo(self.tr('{} distinct points to snap to {} known stations').format(len(points), len(snapper)))
+
+        def snap(point):
+            station = snapper.snap(QgsPointXY(*point))
+            if station is not None:
+                return station['id']
+            try:
+                latitude, longitude = snapper.to_wgs84(QgsPointXY(*point))
+                data = self.client.get('locations', {'x': latitude, 'y': longitude, 'type': 'station'})
+                if len(data['stations']) == 0:
+                    return None
+            except (QgsCsException, SwissPublicTransportError, KeyError) as e:
+                failures.append(self.tr('No station near {}: {!r}').format(point, e))
+                return None
+            learned.extend(data['stations'])
+            return data['stations'][0].get('id')
+
+        failures = []
+        learned = []
+        stations = {}
+        concurrency = self.parameterAsInt(parameters, self.CONCURRENCY, context)
+        for point, station_id in map_ordered(snap, list(points), concurrency, feedback, len(points)):
+            stations[point] = station_id
+
+        for failure in failures:
+            feedback.pushInfo(failure)
+        if learned:
+            feedback.pushInfo(self.tr('{} stations stored in the gazetteer').format(gazetteer.add(learned)))
+        gazetteer.close()
+        return stations
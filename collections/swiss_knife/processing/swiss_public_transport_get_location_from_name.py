@@ -1,26 +1,58 @@
 # -*- coding: utf-8 -*-
 
-import requests
-import json
+import csv
+import os
+import sys
 
 from PyQt5.QtCore import QCoreApplication, QVariant
 from qgis.core import (
     QgsGeometry, QgsPointXY, QgsWkbTypes,
     QgsFeature, QgsField, QgsFields,
     QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsCsException,
     QgsProcessingAlgorithm,
     QgsProcessing,
-    QgsFeatureSink,
+    QgsFeatureRequest,
+    QgsProcessingMultiStepFeedback,
     QgsProcessingParameterFeatureSink,
     QgsProcessingParameterField, QgsProcessingFeatureSource,
-    QgsProcessingParameterVectorLayer
+    QgsProcessingParameterVectorLayer,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterFile,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterCrs,
+    QgsProcessingException,
+    QgsApplication,
+    NULL
 )
 
+sys.path.insert(0, os.path.dirname(__file__))
+from swiss_knife_metrics import AlgorithmMetrics, Metrics  # noqa: E402
+from swiss_public_transport_parameters import SwissPublicTransportClientParameters  # noqa: E402
+from swiss_public_transport_api import (  # noqa: E402
+    SwissPublicTransportError
+)
+from swiss_public_transport_gazetteer import GAZETTEER_FILE, StationGazetteer  # noqa: E402
+
 
-class SwissPublicTransportGetLocationFromName(QgsProcessingAlgorithm):
+class SwissPublicTransportGetLocationFromName(
+        AlgorithmMetrics, SwissPublicTransportClientParameters, QgsProcessingAlgorithm):
+
+    FAILED = 'FAILED'
+    METRIC_OUTPUTS = (FAILED,)
 
     INPUT_LOCATIONS = 'INPUT_LOCATIONS'
     INPUT_FIELD_NAME = 'INPUT_FIELD_NAME'
+    LOOKUP_MODE = 'LOOKUP_MODE'
+    STATION_LIST = 'STATION_LIST'
+    MIN_SIMILARITY = 'MIN_SIMILARITY'
+    OUTPUT_CRS = 'OUTPUT_CRS'
+
+    API = 'API'
+    GAZETTEER_THEN_API = 'GAZETTEER_THEN_API'
+    GAZETTEER_ONLY = 'GAZETTEER_ONLY'
+    LOOKUP_MODES = [API, GAZETTEER_THEN_API, GAZETTEER_ONLY]
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -55,6 +87,49 @@ class SwissPublicTransportGetLocationFromName(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.LOOKUP_MODE,
+                self.tr("Lookup"),
+                options=[
+                    self.tr('API'),
+                    self.tr('Station gazetteer, then API for unknown names'),
+                    self.tr('Station gazetteer only (offline)')
+                ],
+                defaultValue=0
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.STATION_LIST,
+                self.tr('Station list to import in the gazetteer'),
+                extension='csv',
+                optional=True
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MIN_SIMILARITY,
+                self.tr('Minimum name similarity of gazetteer matches (1 for exact matches only)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                maxValue=1,
+                defaultValue=0.8
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterCrs(
+                self.OUTPUT_CRS,
+                self.tr('Output CRS'),
+                defaultValue='EPSG:2056'
+            )
+        )
+
+        self.addClientParameters()
+
+        self.addMetricsParameters()
+
         # Define output parameters
         self.addParameter(
             QgsProcessingParameterFeatureSink(
@@ -68,11 +143,26 @@ class SwissPublicTransportGetLocationFromName(QgsProcessingAlgorithm):
     def displayName(self):
         return self.tr('Get Location from name')
 
+    def shortHelpString(self):
+        return self.tr(
+            'Looks up the station matching the search query of every feature.\n'
+            'Stations returned by the API are stored in a local station gazetteer, which can also '
+            'be filled by importing a station list: a CSV file with id, name, longitude and '
+            'latitude (WGS84) columns, e.g. the service points of opentransportdata.swiss.\n'
+            'The gazetteer lookup modes resolve names locally, by exact match of the normalized '
+            'names or by similarity of their trigrams, without any request for known stations.\n'
+            'Locations are written in the output CRS, Swiss LV95 by default, spt_x and spt_y '
+            'hold the coordinates in that CRS.'
+        )
+
     def outputWkbType(self, input_wkb_type):
         return QgsWkbTypes.Point
 
     def prepareAlgorithm(self, parameters, context, feedback):
         self.headers = {'User-Agent': 'qgis/opengis.ch'}
+
+        self.metrics = Metrics()
+        self.client = self.createClient(parameters, context, self.headers, self.metrics)
         return True
 
     def sourceFlags(self):
@@ -87,6 +177,11 @@ class SwissPublicTransportGetLocationFromName(QgsProcessingAlgorithm):
             parameters, self.INPUT_FIELD_NAME, context
         )
 
+        wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+        output_crs = self.parameterAsCrs(parameters, self.OUTPUT_CRS, context)
+        if not output_crs.isValid():
+            output_crs = wgs84
+
         output_fields = QgsFields(input_locations_data.fields())
         output_fields.append(QgsField('spt_id', QVariant.Int, "int"))
         output_fields.append(QgsField('spt_name', QVariant.String, "text"))
@@ -95,51 +190,124 @@ class SwissPublicTransportGetLocationFromName(QgsProcessingAlgorithm):
 
         (sink, sink_id) = self.parameterAsSink(
             parameters, "OUTPUT", context, output_fields,
-            QgsWkbTypes.Point, QgsCoordinateReferenceSystem("EPSG:4326")
+            QgsWkbTypes.Point, output_crs
         )
 
-        feature_count = input_locations_data.featureCount()
-        progress = 0
-
-        for feature in input_locations_data.getFeatures():
-
-            feedback.setProgress(progress/feature_count*100)
-            progress += 1
-
+        # The API returns WGS84 coordinates, they are reprojected once per
+        # distinct result through a single transform
+        transform = None
+        if output_crs != wgs84:
+            transform = QgsCoordinateTransform(wgs84, output_crs, context.transformContext())
+
+        def query_of(feature):
+            value = feature[field_input_name]
+            return None if value == NULL else value
+
+        # First pass: collect the distinct search queries, reading only the
+        # query field without geometries
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field_input_name], input_locations_data.fields())
+        stations, feature_count = self.readDistinct(input_locations_data, request, query_of, feedback)
+        if stations is None:
+            return {}
+
+        lookup_mode = self.LOOKUP_MODES[self.parameterAsEnum(parameters, self.LOOKUP_MODE, context)]
+        min_similarity = self.parameterAsDouble(parameters, self.MIN_SIMILARITY, context)
+        gazetteer = StationGazetteer(os.path.join(QgsApplication.qgisSettingsDirPath(), GAZETTEER_FILE))
+        station_list = self.parameterAsFile(parameters, self.STATION_LIST, context)
+        if station_list:
+            try:
+                imported = gazetteer.import_file(station_list)
+            except (OSError, ValueError, csv.Error) as e:
+                gazetteer.close()
+                self.client.close()
+                raise QgsProcessingException(self.tr('Cannot import {}: {}').format(station_list, e))
+            feedback.pushInfo(self.tr('{} stations imported in the gazetteer').format(imported))
+
+        def fetch(query):
+            if query is None:
+                self.metrics.count('skipped')
+                return None
+            if lookup_mode != self.API:
+                station = gazetteer.lookup(query, min_similarity)
+                if station is not None or lookup_mode == self.GAZETTEER_ONLY:
+                    return station
             payload = {
-                'query': feature[field_input_name], 'type': 'station'}
-            url = 'http://transport.opendata.ch/v1/locations'
-            resp = requests.get(url, params=payload, headers=self.headers)
-            data = json.loads(resp.content)
-
+                'query': query, 'type': 'station'}
+            try:
+                data = self.client.get('locations', payload)
+                if len(data['stations']) == 0:
+                    return None
+            except (SwissPublicTransportError, KeyError) as e:
+                failures.append(self.tr('No location for {}: {!r}').format(query, e))
+                return None
+            learned.extend(data['stations'])
+            return data['stations'][0]
+
+        # Failed queries get null outputs
+        failures = []
+        # Stations returned by the API, stored in the gazetteer once all are done
+        learned = []
+
+        # Every distinct query is fetched once, requests run concurrently
+        feedback.pushInfo(self.tr('{} distinct locations to query').format(len(stations)))
+        multi_feedback = QgsProcessingMultiStepFeedback(2, feedback)
+        fetched = self.fetchDistinct(stations, fetch, failures, parameters, context, multi_feedback)
+        if learned:
+            feedback.pushInfo(self.tr('{} stations stored in the gazetteer').format(gazetteer.add(learned)))
+        gazetteer.close()
+        if not fetched:
+            return {}
+
+        # The output attributes and geometry of every distinct query are
+        # built once, incomplete results get null outputs
+        outputs = {}
+        for query, station in stations.items():
+            outputs[query] = self.station_outputs(station, query, transform, feedback)
+
+        def features_of(feature):
+            values, geometry = outputs[query_of(feature)]
             new_feature = QgsFeature(output_fields)
-
-            # Clone the existing attributes
-            for i in range(len(input_locations_data.fields())):
-                new_feature.setAttribute(i, feature.attribute(i))
-
-            if len(data['stations']) == 0:
-                pass
-            else:
-                new_feature['spt_id'] = data['stations'][0]['id']
-                # x/y are switched
-                new_feature['spt_x'] = data['stations'][0]['coordinate']['y']
-                new_feature['spt_y'] = data['stations'][0]['coordinate']['x']
-                new_feature['spt_name'] = data['stations'][0]['name']
-
-            if not data['stations'][0]['coordinate']['x'] or not data['stations'][0]['coordinate']['y']:
-                new_feature.setGeometry(QgsGeometry())
-            else:
-                # x/y are switched
-                new_feature.setGeometry(
-                    QgsGeometry.fromPointXY(
-                        QgsPointXY(
-                            data['stations'][0]['coordinate']['y'],
-                            data['stations'][0]['coordinate']['x']
-                        )
-                    )
-                )
-
-            sink.addFeature(new_feature, QgsFeatureSink.FastInsert)
-
-        return {"OUTPUT": sink_id}
+            new_feature.setAttributes(feature.attributes() + values)
+            new_feature.setGeometry(geometry)
+            return [new_feature]
+
+        # Second pass: fan the results out to all features, the output
+        # geometries come from the results so input geometries are not read
+        multi_feedback.setCurrentStep(1)
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        if not self.writeFanOut(input_locations_data, sink, features_of, feature_count, multi_feedback, request):
+            return {}
+
+        results = {"OUTPUT": sink_id}
+        results.update(self.reportMetrics(self.metrics, parameters, context, feedback))
+        return results
+
+    def station_outputs(self, station, query, transform, feedback):
+        """
+        Returns the spt_id, spt_name, spt_x and spt_y values and the point
+        geometry of a station, with nulls for whatever the station is
+        missing. Coordinates are reprojected with the transform if given.
+        """
+        if station is None:
+            return [None] * 4, QgsGeometry()
+        try:
+            # x/y are switched
+            x = float(station['coordinate']['y'])
+            y = float(station['coordinate']['x'])
+        except (KeyError, TypeError, ValueError):
+            feedback.pushInfo(self.tr('No coordinate for {}').format(query))
+            return [station.get('id'), station.get('name'), None, None], QgsGeometry()
+        if not x or not y:
+            return [station.get('id'), station.get('name'), x, y], QgsGeometry()
+
+        point = QgsPointXY(x, y)
+        if transform is not None:
+            try:
+                point = transform.transform(point)
+            except QgsCsException as e:
+                feedback.pushInfo(self.tr('Cannot reproject the location of {}: {}').format(query, e))
+                return [station.get('id'), station.get('name'), None, None], QgsGeometry()
+        return [station.get('id'), station.get('name'), point.x(), point.y()], QgsGeometry.fromPointXY(point)
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+API client parameters shared by the Swiss Public Transport algorithms, and
+the read, fetch and write passes of the algorithms querying the API once
+per distinct input value.
+"""
+
+import os
+import sys
+
+from PyQt5.QtCore import QCoreApplication
+from qgis.core import (
+    QgsApplication,
+    QgsFeatureRequest,
+    QgsProcessingParameterBoolean,
+    QgsProcessingParameterNumber,
+    QgsProcessingParameterString
+)
+
+sys.path.insert(0, os.path.dirname(__file__))
+from swiss_knife_utils import FeatureBatchWriter, map_ordered  # noqa: E402
+from swiss_public_transport_api import (  # noqa: E402
+    CACHE_FILE, DEFAULT_BASE_URL, ResponseCache, SwissPublicTransportClient,
+    create_session, shared_rate_limiter
+)
+
+
+class SwissPublicTransportClientParameters:
+    """
+    Mixin adding the parameters controlling how an algorithm talks to the
+    API, and creating the matching API client.
+
+    It also runs the passes shared by the algorithms which query the API
+    once per distinct value of their input features: readDistinct collects
+    the distinct values, fetchDistinct queries them concurrently and
+    writeFanOut writes the results of every input feature. They use the
+    ``client`` and ``metrics`` attributes set by the algorithm.
+    """
+
+    CONCURRENCY = 'CONCURRENCY'
+    USE_CACHE = 'USE_CACHE'
+    TIMEOUT = 'TIMEOUT'
+    MAX_RETRIES = 'MAX_RETRIES'
+    RATE_LIMIT = 'RATE_LIMIT'
+    RATE_BURST = 'RATE_BURST'
+    BASE_URL = 'BASE_URL'
+
+    def addClientParameters(self):
+        tr = lambda string: QCoreApplication.translate('Processing', string)  # noqa: E731
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.CONCURRENCY,
+                tr('Concurrent requests'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                maxValue=32,
+                defaultValue=4
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.USE_CACHE,
+                tr('Cache API responses'),
+                defaultValue=True
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.TIMEOUT,
+                tr('Request timeout (seconds)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=1,
+                defaultValue=30
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.MAX_RETRIES,
+                tr('Maximum retries per request'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=0,
+                defaultValue=5
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.RATE_LIMIT,
+                tr('Maximum requests per second, shared by all running SPT algorithms (0 for no limit)'),
+                type=QgsProcessingParameterNumber.Double,
+                minValue=0,
+                defaultValue=5
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.RATE_BURST,
+                tr('Maximum burst of requests'),
+                type=QgsProcessingParameterNumber.Integer,
+                minValue=1,
+                defaultValue=10
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+                self.BASE_URL,
+                tr('API base URL'),
+                defaultValue=DEFAULT_BASE_URL
+            )
+        )
+
+    def createClient(self, parameters, context, headers, metrics=None):
+        cache = None
+        if self.parameterAsBoolean(parameters, self.USE_CACHE, context):
+            cache = ResponseCache(os.path.join(QgsApplication.qgisSettingsDirPath(), CACHE_FILE))
+        return SwissPublicTransportClient(
+            base_url=self.parameterAsString(parameters, self.BASE_URL, context),
+            cache=cache,
+            rate_limiter=shared_rate_limiter(
+                self.parameterAsDouble(parameters, self.RATE_LIMIT, context),
+                self.parameterAsInt(parameters, self.RATE_BURST, context)
+            ),
+            session=create_session(headers, pool_size=self.parameterAsInt(parameters, self.CONCURRENCY, context)),
+            timeout=self.parameterAsDouble(parameters, self.TIMEOUT, context),
+            max_retries=self.parameterAsInt(parameters, self.MAX_RETRIES, context),
+            metrics=metrics
+        )
+
+    def readDistinct(self, layer, request, key_of, feedback):
+        """
+        First pass over the features of ``layer`` read with ``request``.
+        Returns a dict mapping the distinct keys of the features, in the
+        order of the features, to None, and the number of features. The
+        dict is None if canceled.
+        """
+        with self.metrics.timer('read'):
+            keys = {}
+            feature_count = 0
+            for feature in layer.getFeatures(request):
+                if feedback.isCanceled():
+                    self.client.close()
+                    return None, 0
+                keys[key_of(feature)] = None
+                feature_count += 1
+        return keys, feature_count
+
+    def fetchDistinct(self, results, fetch, failures, parameters, context, feedback):
+        """
+        Calls ``fetch`` once per key of ``results``, up to CONCURRENCY calls
+        at a time, and stores what it returns in ``results``. The messages
+        ``fetch`` appends to ``failures`` are reported once all calls are
+        done, then the client is closed. Returns False if canceled.
+        """
+        concurrency = self.parameterAsInt(parameters, self.CONCURRENCY, context)
+        with self.metrics.timer('fetch'):
+            for key, result in map_ordered(fetch, list(results), concurrency, feedback, len(results)):
+                results[key] = result
+
+        for failure in failures:
+            feedback.pushInfo(failure)
+        self.metrics.count('failed', len(failures))
+        self.client.close(feedback)
+        return not feedback.isCanceled()
+
+    def writeFanOut(self, layer, sink, features_of, feature_count, feedback, request=None):
+        """
+        Second pass over the features of ``layer``, read with ``request`` if
+        given. The output features returned by ``features_of`` for every
+        input feature are written to the sink in batches. Returns False if
+        canceled.
+        """
+        writer = FeatureBatchWriter(sink)
+        with self.metrics.timer('write'):
+            for current, feature in enumerate(layer.getFeatures(request or QgsFeatureRequest())):
+                if feedback.isCanceled():
+                    return False
+                for new_feature in features_of(feature):
+                    writer.add(new_feature)
+                feedback.setProgress(current / feature_count * 100)
+            writer.flush()
+        return True
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""
+Snapping of points to the nearest public transport stop, used by the Swiss
+Public Transport algorithms taking point inputs.
+"""
+
+from qgis.core import (QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransform,
+                       QgsCsException,
+                       QgsFeature,
+                       QgsGeometry,
+                       QgsPointXY,
+                       QgsSpatialIndex)
+
+
+class StationSnapper:
+    """
+    Spatial index of stations in the shape of the /locations API, whose
+    coordinate x is the latitude and y the longitude.
+
+    Stations and snapped points are projected in Swiss LV95, so that snapping
+    distances are in meters.
+    """
+
+    def __init__(self, stations, source_crs, transform_context, max_distance=500):
+        self.max_distance = max_distance
+        wgs84 = QgsCoordinateReferenceSystem('EPSG:4326')
+        lv95 = QgsCoordinateReferenceSystem('EPSG:2056')
+        self._from_wgs84 = QgsCoordinateTransform(wgs84, lv95, transform_context)
+        self._from_source = QgsCoordinateTransform(source_crs, lv95, transform_context)
+        self._to_wgs84 = QgsCoordinateTransform(source_crs, wgs84, transform_context)
+
+        self.stations = []
+        self.points = []
+        self.index = QgsSpatialIndex()
+        for station in stations:
+            coordinate = station['coordinate']
+            try:
+                point = self._from_wgs84.transform(QgsPointXY(coordinate['y'], coordinate['x']))
+            except QgsCsException:
+                continue
+            feature = QgsFeature(len(self.stations))
+            feature.setGeometry(QgsGeometry.fromPointXY(point))
+            self.index.addFeature(feature)
+            self.stations.append(station)
+            self.points.append(point)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def snap(self, point):
+        """
+        Returns the nearest station of a point given in the source CRS, or
+        None if there is no station within the maximum distance.
+        """
+        try:
+            projected = self._from_source.transform(point)
+        except QgsCsException:
+            return None
+        for position in self.index.nearestNeighbor(projected, 1, self.max_distance):
+            if self.points[position].distance(projected) <= self.max_distance:
+                return self.stations[position]
+        return None
+
+    def to_wgs84(self, point):
+        """
+        Returns the (latitude, longitude) of a point given in the source CRS.
+        """
+        wgs84 = self._to_wgs84.transform(point)
+        return wgs84.y(), wgs84.x()
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import time
+import unicodedata
+
+from PyQt5.QtCore import QCoreApplication, QVariant, QDateTime
+from qgis.core import (
+    QgsVectorLayer,
+    QgsFeature, QgsField, QgsFields,
+    QgsCoordinateReferenceSystem,
+    QgsProcessingAlgorithm,
+    QgsProcessing,
+    QgsFeatureRequest,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterEnum,
+    QgsProcessingParameterDateTime,
+    QgsProcessingParameterField,
+    QgsProcessingParameterBoolean,
+    QgsProcessingFeatureSource,
+    QgsProcessingParameterVectorLayer,
+    QgsWkbTypes,
+    NULL
+)
+
+sys.path.insert(0, os.path.dirname(__file__))
+from swiss_knife_metrics import AlgorithmMetrics, Metrics  # noqa: E402
+from swiss_knife_utils import FeatureBatchWriter, map_ordered  # noqa: E402
+from swiss_public_transport_parameters import SwissPublicTransportClientParameters  # noqa: E402
+from swiss_public_transport_api import SwissPublicTransportError, fetch_connection_duration  # noqa: E402
+
+# Failures reported in the log, the others are only counted
+MAX_REPORTED_FAILURES = 100
+
+# Travel times kept for the rows of their reverse pairs in the wide format,
+# the reverse pairs of the others are requested again
+MAX_PENDING_REVERSE = 100000
+
+# Maximum length of field names in shapefiles
+SHAPEFILE_FIELD_LENGTH = 10
+
+INVALID_FIELD_CHARACTERS_RE = re.compile(r'\W+')
+
+
+def column_names(values, reserved=(), max_length=None):
+    """
+    Returns a field name for every value: accents are removed, characters
+    which are not ASCII letters, digits or underscores are replaced by
+    underscores, names are cut to ``max_length`` characters and made
+    unique, case insensitively, among themselves and the ``reserved``
+    names, by a numeric suffix.
+    """
+    used = {name.casefold() for name in reserved}
+    columns = {}
+    for value in values:
+        ascii_value = unicodedata.normalize('NFKD', str(value)).encode('ascii', 'ignore').decode('ascii')
+        base = INVALID_FIELD_CHARACTERS_RE.sub('_', ascii_value).strip('_') or 'field'
+        if base[0].isdigit():
+            base = '_' + base
+        name = base[:max_length]
+        suffix = 1
+        while name.casefold() in used:
+            suffix += 1
+            tail = '_{}'.format(suffix)
+            name = base[:max_length - len(tail) if max_length else None] + tail
+        used.add(name.casefold())
+        columns[value] = name
+    return columns
+
+
+class SwissPublicTransportTravelTimeMatrix(
+        AlgorithmMetrics, SwissPublicTransportClientParameters, QgsProcessingAlgorithm):
+
+    FAILED = 'FAILED'
+    REUSED = 'REUSED'
+    METRIC_OUTPUTS = (FAILED, REUSED)
+
+    ORIGIN_LAYER = 'ORIGIN_LAYER'
+    ORIGIN_FIELD = 'ORIGIN_FIELD'
+    DESTINATION_LAYER = 'DESTINATION_LAYER'
+    DESTINATION_FIELD = 'DESTINATION_FIELD'
+    METHOD = 'METHOD'
+    DATE_TIME = 'DATE_TIME'
+    SYMMETRIC = 'SYMMETRIC'
+    FORMAT = 'FORMAT'
+
+    SOONEST = 'SOONEST'
+    FASTEST = 'FASTEST'
+    METHODS = [SOONEST, FASTEST]
+
+    LONG = 'LONG'
+    WIDE = 'WIDE'
+    FORMATS = [LONG, WIDE]
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return SwissPublicTransportTravelTimeMatrix()
+
+    def group(self):
+        return self.tr('Swiss Public Transport API')
+
+    def groupId(self):
+        return 'SwissPublicTransportAPI'
+
+    def __init__(self):
+        super().__init__()
+
+    def initAlgorithm(self, config):
+
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.ORIGIN_LAYER,
+                self.tr("Origin layer"),
+                [QgsProcessing.TypeVector]
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.ORIGIN_FIELD,
+                self.tr('Origin'),
+                parentLayerParameterName=self.ORIGIN_LAYER,
+                type=QgsProcessingParameterField.String
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+                self.DESTINATION_LAYER,
+                self.tr("Destination layer"),
+                [QgsProcessing.TypeVector]
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.DESTINATION_FIELD,
+                self.tr('Destination'),
+                parentLayerParameterName=self.DESTINATION_LAYER,
+                type=QgsProcessingParameterField.String
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterDateTime(
+                self.DATE_TIME,
+                self.tr('Departing time'),
+                type=QgsProcessingParameterDateTime.Type.DateTime,
+                defaultValue=QDateTime.currentDateTime()
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.METHOD, self.tr("Returned result"), options=self.METHODS, defaultValue=0
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.SYMMETRIC,
+                self.tr('Assume travel times are symmetric (request every pair of stations in one direction only)'),
+                defaultValue=False
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.FORMAT,
+                self.tr("Output table"),
+                options=[
+                    self.tr('Long: one row per origin and destination'),
+                    self.tr('Wide: one row per origin, one column per destination')
+                ],
+                defaultValue=0
+            )
+        )
+
+        self.addClientParameters()
+
+        self.addMetricsParameters()
+
+        # Define output parameters
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                "OUTPUT", self.tr("Swiss Public Transport Travel Time Matrix"), type=QgsProcessing.TypeVector
+            )
+        )
+
+    def name(self):
+        return 'spt-gettraveltimematrix'
+
+    def displayName(self):
+        return self.tr('Get Travel Time Matrix')
+
+    def shortHelpString(self):
+        return self.tr(
+            'Computes the travel time (in minutes) from every distinct origin of the origin layer to '
+            'every distinct destination of the destination layer.\n'
+            'Pairs are generated and requested on the fly, and the table is written while '
+            'requests complete, so the whole matrix is never held in memory. '
+            'The travel time from a station to itself is 0 and is not requested.\n'
+            'With symmetric travel times, the travel time of a pair of stations found in both layers '
+            'is requested in one direction only and reused for the other one. In the wide format, '
+            'up to {} travel times are kept until the row of their reverse pair, the reverse '
+            'pairs of the others are requested again.\n'
+            'The long table has the spt_from, spt_to and spt_duration fields, the wide table has a '
+            'spt_from field and one field per destination. Destination names are turned into valid '
+            'and unique field names, the renamed ones are listed in the log.'
+        ).format(MAX_PENDING_REVERSE)
+
+    def prepareAlgorithm(self, parameters, context, feedback):
+        self.headers = {'User-Agent': 'qgis/opengis.ch'}
+
+        self.metrics = Metrics()
+        self.client = self.createClient(parameters, context, self.headers, self.metrics)
+        return True
+
+    def sourceFlags(self):
+        return QgsProcessingFeatureSource.FlagSkipGeometryValidityChecks
+
+    def distinct_values(self, layer: QgsVectorLayer, field, feedback):
+        """
+        Returns the distinct non null values of a field, in the order of the
+        features, reading only that field without geometries.
+        """
+        request = QgsFeatureRequest()
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([field], layer.fields())
+        values = {}
+        for feature in layer.getFeatures(request):
+            if feedback.isCanceled():
+                break
+            value = feature[field]
+            if value != NULL and value not in values:
+                values[value] = len(values)
+        return values
+
+    def processAlgorithm(self, parameters, context, feedback):
+
+        origin_layer = self.parameterAsLayer(parameters, self.ORIGIN_LAYER, context)
+        origin_field = self.parameterAsString(parameters, self.ORIGIN_FIELD, context)
+        destination_layer = self.parameterAsLayer(parameters, self.DESTINATION_LAYER, context)
+        destination_field = self.parameterAsString(parameters, self.DESTINATION_FIELD, context)
+        date_time: QDateTime = self.parameterAsDateTime(parameters, self.DATE_TIME, context)
+        # Both output modes request the wall clock time of the parameter
+        date = date_time.date().toString('yyyy-MM-dd')
+        time_of_day = date_time.time().toString('HH:mm')
+        method = self.METHODS[self.parameterAsEnum(parameters, self.METHOD, context)]
+        symmetric = self.parameterAsBoolean(parameters, self.SYMMETRIC, context)
+        output_format = self.FORMATS[self.parameterAsEnum(parameters, self.FORMAT, context)]
+        concurrency = self.parameterAsInt(parameters, self.CONCURRENCY, context)
+
+        # Only the distinct origins and destinations are held in memory, with
+        # their position
+        read_start = time.perf_counter()
+        origins = self.distinct_values(origin_layer, origin_field, feedback)
+        destinations = self.distinct_values(destination_layer, destination_field, feedback)
+        self.metrics.add_time('read', time.perf_counter() - read_start)
+        if feedback.isCanceled():
+            self.client.close()
+            return {}
+
+        output_fields = QgsFields()
+        output_fields.append(QgsField('spt_from', QVariant.String, "text"))
+        if output_format == self.LONG:
+            output_fields.append(QgsField('spt_to', QVariant.String, "text"))
+            output_fields.append(QgsField('spt_duration', QVariant.Double, "double"))
+        else:
+            # Destination names are not necessarily valid, unique or short
+            # enough field names
+            output_path = self.parameterAsOutputLayer(parameters, "OUTPUT", context)
+            max_length = SHAPEFILE_FIELD_LENGTH if output_path.lower().endswith(('.shp', '.dbf')) else None
+            columns = column_names(destinations, ['spt_from'], max_length)
+            for destination, column in columns.items():
+                if column != destination:
+                    feedback.pushInfo(self.tr('Destination {} is written in field {}').format(destination, column))
+                output_fields.append(QgsField(column, QVariant.Double, "double"))
+
+        (sink, sink_id) = self.parameterAsSink(
+            parameters, "OUTPUT", context, output_fields,
+            QgsWkbTypes.NoGeometry, QgsCoordinateReferenceSystem()
+        )
+
+        def reused(pair):
+            """
+            Whether the travel time of a pair is the one of its reverse pair,
+            requested before it with symmetric travel times.
+            """
+            origin, destination = pair
+            return (symmetric and destination in origins and origin in destinations and
+                    origins[destination] < origins[origin])
+
+        def reverse_wanted(pair):
+            """
+            Whether the travel time of a requested pair is reused for its
+            reverse pair, generated after it.
+            """
+            origin, destination = pair
+            return (symmetric and destination in origins and origin in destinations and
+                    origins[destination] > origins[origin])
+
+        def pairs():
+            for origin in origins:
+                for destination in destinations:
+                    yield origin, destination
+
+        def fetch(pair):
+            if pair[0] == pair[1]:
+                return 0.0
+            if reused(pair):
+                if output_format == self.LONG:
+                    # Written with its reverse pair
+                    return None
+                # The reverse pair was requested for a previous row
+                duration = pending_reverse.pop(pair, missing)
+                if duration is not missing:
+                    self.metrics.count('reused')
+                    return duration
+                # Not kept, or requested before the previous row was written
+                pair = (pair[1], pair[0])
+            try:
+                with self.metrics.timer('fetch'):
+                    return fetch_connection_duration(
+                        self.client, pair[0], pair[1], date, time_of_day,
+                        method == self.FASTEST
+                    )
+            except (SwissPublicTransportError, KeyError, ValueError) as e:
+                failures[0] += 1
+                if failures[0] <= MAX_REPORTED_FAILURES:
+                    failure_messages.append(self.tr('No connection for {}: {!r}').format(pair, e))
+                return None
+
+        # Failed queries get null outputs, the first MAX_REPORTED_FAILURES are logged
+        failures = [0]
+        failure_messages = []
+
+        # Wide format travel times waiting for the row of their reverse pair,
+        # only added while the results are written in order
+        pending_reverse = {}
+        missing = object()
+
+        writer = FeatureBatchWriter(sink)
+
+        def write(values):
+            with self.metrics.timer('write'):
+                new_feature = QgsFeature(output_fields)
+                new_feature.setAttributes(values)
+                writer.add(new_feature)
+
+        row_origin = None
+        row = []
+
+        total = len(origins) * len(destinations)
+        feedback.pushInfo(self.tr('{} origins and {} destinations, {} pairs').format(
+            len(origins), len(destinations), total))
+        for pair, duration in map_ordered(fetch, pairs(), concurrency, feedback, total):
+            origin, destination = pair
+            if output_format == self.LONG:
+                if reused(pair):
+                    # Already written with its reverse pair
+                    self.metrics.count('reused')
+                    continue
+                if reverse_wanted(pair):
+                    write([str(destination), str(origin), duration])
+            elif reverse_wanted(pair):
+                if len(pending_reverse) < MAX_PENDING_REVERSE:
+                    pending_reverse[(destination, origin)] = duration
+            elif reused(pair):
+                # Kept after this pair was requested again
+                pending_reverse.pop(pair, None)
+
+            if output_format == self.LONG:
+                write([str(origin), str(destination), duration])
+                continue
+            if origin != row_origin:
+                if row_origin is not None:
+                    write([str(row_origin)] + row)
+                row_origin = origin
+                row = []
+            row.append(duration)
+        if not feedback.isCanceled() and row_origin is not None:
+            write([str(row_origin)] + row)
+        writer.flush()
+
+        for failure in failure_messages:
+            feedback.pushInfo(failure)
+        if failures[0] > len(failure_messages):
+            feedback.pushInfo(self.tr('{} more failures').format(failures[0] - len(failure_messages)))
+        self.metrics.count('failed', failures[0])
+        self.client.close(feedback)
+        if feedback.isCanceled():
+            return {}
+
+        results = {"OUTPUT": sink_id}
+        results.update(self.reportMetrics(self.metrics, parameters, context, feedback))
+        return results
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+Incremental update of an existing GeoPackage output by the M-value
+interpolation. Needs QGIS, skipped without it.
+
+Run with: python3 -m pytest collections/swiss_knife/tests
+"""
+
+import functools
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('qgis.core')
+from qgis.core import (  # noqa: E402
+    QgsFeature,
+    QgsGeometry,
+    QgsProcessingAlgorithm,
+    QgsProcessingFeedback,
+    QgsVectorFileWriter,
+    QgsVectorLayer
+)
+from qgis.testing import start_app  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'processing'))
+from interpolateMvalues_Line_numpy import InterpolateMValuesNumpy  # noqa: E402
+from interpolateMvalues_incremental import process_incrementally  # noqa: E402
+from interpolateMvalues_kernel import interpolate_masked  # noqa: E402
+from swiss_knife_metrics import Metrics  # noqa: E402
+
+start_app()
+
+OPTIONS = 'default'
+
+
+def input_layer(lines):
+    """
+    Returns a memory layer of LineStringM features, by key.
+    """
+    layer = QgsVectorLayer('LineStringM?crs=EPSG:2056&field=key:string', 'input', 'memory')
+    features = []
+    for key, wkt in lines.items():
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([key])
+        feature.setGeometry(QgsGeometry.fromWkt(wkt))
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+def set_geometry(layer, key, wkt):
+    for feature in layer.getFeatures():
+        if feature['key'] == key:
+            layer.dataProvider().changeGeometryValues({feature.id(): QgsGeometry.fromWkt(wkt)})
+
+
+def output_features(layer):
+    """
+    Returns the (feature id, M-values) of the output features, by key.
+    """
+    return {
+        feature['key']: (feature.id(), [vertex.m() for vertex in feature.geometry().vertices()])
+        for feature in layer.getFeatures()
+    }
+
+
+def update(source, output):
+    metrics = Metrics()
+    process_incrementally(
+        source, output, 'key', functools.partial(interpolate_masked), OPTIONS, 1000, QgsProcessingFeedback(),
+        metrics=metrics
+    )
+    return metrics.counters
+
+
+@pytest.fixture
+def layers(tmp_path):
+    source = input_layer({
+        'a': 'LineStringM (0 0 10, 1 0 0, 2 0 30)',
+        'b': 'LineStringM (0 0 10, 1 0 0, 2 0 50)',
+    })
+    path = str(tmp_path / 'output.gpkg')
+    QgsVectorFileWriter.writeAsVectorFormat(source, path, 'utf-8', source.crs(), 'GPKG')
+    output = QgsVectorLayer(path, 'output', 'ogr')
+    assert output.isValid()
+    return source, output
+
+
+def test_unchanged_input_rewrites_nothing(layers):
+    source, output = layers
+    assert update(source, output)['changed'] == 2
+    first = output_features(output)
+    assert first['a'][1] == [10, 20, 30]
+    assert first['b'][1] == [10, 30, 50]
+
+    counters = update(source, output)
+    assert counters.get('changed', 0) == 0
+    assert counters['unchanged'] == 2
+    assert counters.get('deleted', 0) == 0
+    assert output_features(output) == first
+
+
+def test_changed_input_rewrites_its_feature_only(layers):
+    source, output = layers
+    update(source, output)
+    first = output_features(output)
+
+    set_geometry(source, 'b', 'LineStringM (0 0 10, 1 0 0, 3 0 40)')
+    counters = update(source, output)
+    assert counters['changed'] == 1
+    assert counters['unchanged'] == 1
+    second = output_features(output)
+    assert second['a'] == first['a']
+    assert second['b'][0] != first['b'][0]
+    assert second['b'][1] == [10, 20, 40]
+
+
+def test_algorithm_runs_in_the_main_thread():
+    assert InterpolateMValuesNumpy().flags() & QgsProcessingAlgorithm.FlagNoThreading
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Masked interpolation kernel, on hand-computed lines and against the pure
+Python kernel it replaced on random ragged chunks. Only numpy is needed,
+QGIS is not.
+
+Run with: python3 -m pytest collections/swiss_knife/tests
+"""
+
+import itertools
+import os
+import sys
+from math import hypot
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'processing'))
+from interpolateMvalues_kernel import (  # noqa: E402
+    ENDS_KEEP, ENDS_LINEAR, ENDS_NEAREST, MISSING_BELOW, MISSING_NAN, MISSING_ZERO,
+    interpolate_masked
+)
+
+CHUNKS = 3000
+
+
+def reference_python(x, y, m, offsets, parts=None):
+    """
+    Previous pure Python kernel: zero M-values between non-zero M-values,
+    rounded to integers, line ends left untouched.
+    """
+    part_starts = set(offsets if parts is None else parts)
+    m_interpolated = list(m)
+    for start, end in zip(offsets, offsets[1:]):
+        distances = list(itertools.accumulate(
+            0.0 if i in part_starts else hypot(x[i] - x[i - 1], y[i] - y[i - 1])
+            for i in range(start + 1, end)
+        ))
+        distances.insert(0, 0.0)
+
+        previous = None
+        for i in range(start, end):
+            if m[i] == 0:
+                continue
+            if previous is not None and i - previous > 1:
+                first_nonzero = m[previous]
+                sum_seg = distances[i - start] - distances[previous - start]
+                for j in range(previous + 1, i):
+                    if sum_seg == 0:
+                        m_interpolated[j] = first_nonzero
+                    else:
+                        dist = distances[j - start] - distances[previous - start]
+                        m_interpolated[j] = round(((dist/sum_seg)*(m[i]-first_nonzero))+first_nonzero, 0)
+            previous = i
+    return m_interpolated
+
+
+def random_chunks(count, seed=0):
+    """
+    Yields random ragged chunks (x, y, m, offsets, parts): lines of one or
+    more parts, with zero M-values, repeated vertices and lines without any
+    known M-value.
+    """
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        parts = [0]
+        offsets = [0]
+        for _line in range(rng.integers(1, 8)):
+            for _part in range(rng.integers(1, 4)):
+                parts.append(parts[-1] + int(rng.integers(1, 20)))
+            offsets.append(parts[-1])
+        vertices = parts[-1]
+        x = rng.uniform(0, 1000, vertices)
+        y = rng.uniform(0, 1000, vertices)
+        repeated = rng.random(vertices) < 0.1
+        x[1:][repeated[1:]] = x[:-1][repeated[1:]]
+        y[1:][repeated[1:]] = y[:-1][repeated[1:]]
+        m = np.where(rng.random(vertices) < rng.uniform(0.2, 0.9), 0.0, rng.integers(1, 10000, vertices))
+        yield x.tolist(), y.tolist(), m.tolist(), offsets, parts
+
+
+@pytest.mark.parametrize('across_parts', [False, True])
+def test_kept_ends_match_previous_python_kernel(across_parts):
+    for x, y, m, offsets, parts in random_chunks(CHUNKS, seed=1):
+        if not across_parts:
+            offsets = parts
+        expected = reference_python(x, y, m, offsets, parts)
+        np.testing.assert_array_equal(interpolate_masked(x, y, m, offsets, parts, ends=ENDS_KEEP), expected)
+
+
+def line(m):
+    """
+    Returns the chunk (x, y, m, offsets) of a single straight line with one
+    unit between its vertices.
+    """
+    return list(range(len(m))), [0] * len(m), m, [0, len(m)]
+
+
+def test_zero_m_values_between_known_m_values():
+    np.testing.assert_array_equal(interpolate_masked(*line([0, 10, 0, 0, 40, 0])), [10, 10, 20, 30, 40, 40])
+
+
+def test_nan_m_values_are_missing():
+    nan = float('nan')
+    np.testing.assert_array_equal(
+        interpolate_masked(*line([nan, 0, nan, 30]), missing=MISSING_NAN), [0, 0, 15, 30]
+    )
+    np.testing.assert_array_equal(
+        interpolate_masked(*line([nan, 0, nan, 30]), missing=MISSING_ZERO), [30, 30, 30, 30]
+    )
+
+
+def test_m_values_below_a_threshold_are_missing():
+    nan = float('nan')
+    np.testing.assert_array_equal(
+        interpolate_masked(*line([2, 10, 4, -1, 40, nan, 6]), missing=MISSING_BELOW, threshold=5),
+        [10, 10, 20, 30, 40, 23, 6]
+    )
+
+
+def test_decimals():
+    m = [10, 0, 0, 20]
+    np.testing.assert_array_equal(interpolate_masked(*line(m)), [10, 13, 17, 20])
+    np.testing.assert_array_equal(interpolate_masked(*line(m), decimals=1), [10, 13.3, 16.7, 20])
+    np.testing.assert_allclose(interpolate_masked(*line(m), decimals=None), [10, 10 + 10 / 3, 10 + 20 / 3, 20])
+    # Known M-values are never rounded
+    np.testing.assert_array_equal(interpolate_masked(*line([10.25, 0, 20.75])), [10.25, 16, 20.75])
+
+
+def test_ends():
+    m = [0, 0, 10, 20, 0, 0]
+    np.testing.assert_array_equal(interpolate_masked(*line(m), ends=ENDS_KEEP), m)
+    np.testing.assert_array_equal(interpolate_masked(*line(m), ends=ENDS_NEAREST), [10, 10, 10, 20, 20, 20])
+    np.testing.assert_array_equal(interpolate_masked(*line(m), ends=ENDS_LINEAR), [-10, 0, 10, 20, 30, 40])
+    # Uneven distances
+    x, y = [0, 1, 3, 4, 8], [0, 0, 0, 0, 0]
+    np.testing.assert_array_equal(
+        interpolate_masked(x, y, [0, 5, 0, 20, 0], [0, 5], ends=ENDS_LINEAR), [0, 5, 15, 20, 40]
+    )
+    # A single known M-value is extended
+    np.testing.assert_array_equal(interpolate_masked(*line([0, 5, 0]), ends=ENDS_LINEAR), [5, 5, 5])
+
+
+def test_repeated_vertices():
+    np.testing.assert_array_equal(interpolate_masked([0, 0, 0], [0, 0, 0], [10, 0, 20], [0, 3]), [10, 10, 20])
+    np.testing.assert_array_equal(
+        interpolate_masked([0, 1, 1, 1], [0, 0, 0, 0], [0, 10, 0, 20], [0, 4], ends=ENDS_LINEAR),
+        [10, 10, 10, 20]
+    )
+
+
+@pytest.mark.parametrize('ends', [ENDS_KEEP, ENDS_NEAREST, ENDS_LINEAR])
+def test_single_vertex_and_all_missing_lines(ends):
+    # A single vertex, a line without any known M-value and a line with a
+    # single known M-value, none of them takes M-values of the others
+    x = [0, 10, 11, 12, 20, 21, 30]
+    m = [0, 0, 0, 0, 0, 7, 3]
+    expected = [0, 0, 0, 0, 0 if ends == ENDS_KEEP else 7, 7, 3]
+    np.testing.assert_array_equal(interpolate_masked(x, [0] * 7, m, [0, 1, 4, 6, 7], ends=ends), expected)
+
+
+def test_parts_of_multipart_features():
+    # Two features, the first one of two parts 98 units apart, the second
+    # one of a single part
+    x = [0, 1, 2, 100, 101, 102, 200, 201, 202]
+    y = [0] * 9
+    m = [10, 0, 0, 0, 0, 50, 0, 5, 0]
+    parts = [0, 3, 6, 9]
+    # Per part
+    np.testing.assert_array_equal(
+        interpolate_masked(x, y, m, parts, parts), [10, 10, 10, 50, 50, 50, 5, 5, 5]
+    )
+    # Across parts, the gap between the parts has no length
+    np.testing.assert_array_equal(
+        interpolate_masked(x, y, m, [0, 6, 9], parts), [10, 20, 30, 30, 40, 50, 5, 5, 5]
+    )
+    # Across parts, without the part boundaries the gap is measured
+    np.testing.assert_array_equal(
+        interpolate_masked(x, y, m, [0, 6, 9]), [10, 10, 11, 49, 50, 50, 5, 5, 5]
+    )
+
+
+def test_empty_chunk():
+    assert len(interpolate_masked([], [], [], [0])) == 0
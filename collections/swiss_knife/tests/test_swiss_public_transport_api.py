@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parsing of the /connections responses of the transport.opendata.ch API.
+Only requests is needed, QGIS is not.
+
+Run with: python3 -m pytest collections/swiss_knife/tests
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'processing'))
+from swiss_public_transport_api import (  # noqa: E402
+    SwissPublicTransportError, connection_durations, connection_timestamps
+)
+
+
+def projected(*timestamps):
+    """
+    Returns a response projected on DURATION_FIELDS with the given
+    (departure, arrival) timestamps.
+    """
+    return json.dumps({'connections': [
+        {'from': {'departureTimestamp': departure}, 'to': {'arrivalTimestamp': arrival}}
+        for departure, arrival in timestamps
+    ]})
+
+
+def test_projected_response():
+    content = projected((1000, 1600), (2000, 2900))
+    assert connection_timestamps(content) == [(1000, 1600), (2000, 2900)]
+    assert connection_durations(content) == [10, 15]
+
+
+def test_projected_response_without_connections():
+    assert connection_timestamps(projected()) == []
+
+
+def test_unprojected_response():
+    # Sections and prognoses have departure timestamps of their own, only
+    # those of the connections are returned
+    content = json.dumps({
+        'connections': [
+            {
+                'from': {
+                    'station': {'id': '8507000', 'name': 'Bern'},
+                    'departure': '2022-08-15T08:02:00+0200',
+                    'departureTimestamp': 1660543320,
+                    'prognosis': {'departureTimestamp': 1660543380},
+                    'platform': '7'
+                },
+                'to': {
+                    'station': {'id': '8503000', 'name': 'Zürich HB'},
+                    'arrivalTimestamp': 1660546680
+                },
+                'sections': [
+                    {
+                        'departure': {'departureTimestamp': 1660543320, 'arrivalTimestamp': None},
+                        'arrival': {'departureTimestamp': None, 'arrivalTimestamp': 1660545000}
+                    },
+                    {
+                        'departure': {'departureTimestamp': 1660545300, 'arrivalTimestamp': None},
+                        'arrival': {'departureTimestamp': None, 'arrivalTimestamp': 1660546680}
+                    }
+                ]
+            },
+            {
+                'from': {'departureTimestamp': 1660545120},
+                'to': {'arrivalTimestamp': 1660548540},
+                'sections': []
+            }
+        ],
+        'from': {'id': '8507000'},
+        'to': {'id': '8503000'}
+    }, indent=2)
+    assert connection_timestamps(content) == [(1660543320, 1660546680), (1660545120, 1660548540)]
+    assert connection_durations(content) == [56, 57]
+
+
+def test_null_timestamps():
+    content = projected((1000, None), (None, 2000), (3000, 3600))
+    assert connection_timestamps(content) == [(1000, None), (None, 2000), (3000, 3600)]
+    assert connection_durations(content) == [None, None, 10]
+
+
+def test_missing_timestamps_do_not_shift_the_others():
+    content = json.dumps({'connections': [
+        {'from': {}, 'to': {'arrivalTimestamp': 1600}},
+        {'from': {'departureTimestamp': 2000}, 'to': {'arrivalTimestamp': 2600}},
+        {'from': {'departureTimestamp': 3000}},
+        {'from': {'departureTimestamp': 4000}, 'to': {'arrivalTimestamp': 4900}}
+    ]})
+    assert connection_timestamps(content) == [(None, 1600), (2000, 2600), (3000, None), (4000, 4900)]
+
+
+def test_response_without_connections():
+    with pytest.raises(SwissPublicTransportError):
+        connection_timestamps(json.dumps({'errors': [{'message': 'Not found'}]}))
+
+
+def test_invalid_response():
+    with pytest.raises(ValueError):
+        connection_timestamps('<html>Bad gateway</html>')
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+Departure time sweep and connection duration lookups of the Swiss Public
+Transport algorithms, against a scripted timetable and the mock server of
+the benchmarks. Only requests is needed, QGIS is not.
+
+Run with: python3 -m pytest collections/swiss_knife/tests
+"""
+
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'processing'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', '..', 'benchmarks'))
+from mock_transport_server import MockTransportServer  # noqa: E402
+from swiss_public_transport_api import (  # noqa: E402
+    ResponseCache, SwissPublicTransportClient,
+    connection_statistics, fetch_connection_duration, sweep_connections
+)
+
+
+def at(hour, minute, second=0):
+    """
+    Returns the timestamp of a local time of an arbitrary day.
+    """
+    return int(time.mktime((2026, 10, 17, hour, minute, second, 0, 0, -1)))
+
+
+class TimetableClient:
+    """
+    Client answering /connections queries from a list of (departure,
+    arrival) timestamps like the API: the connections departing from the
+    requested minute on, sorted by departure, ``limit`` at most.
+    """
+
+    cache = None
+    metrics = None
+
+    def __init__(self, timetable):
+        self.timetable = sorted(timetable)
+        self.requests = []
+
+    def get_content(self, endpoint, params):
+        self.requests.append((params['date'], params['time']))
+        requested = int(time.mktime(time.strptime('{} {}'.format(params['date'], params['time']), '%Y-%m-%d %H:%M')))
+        connections = [
+            {'from': {'departureTimestamp': departure}, 'to': {'arrivalTimestamp': arrival}}
+            for departure, arrival in self.timetable if departure >= requested
+        ]
+        return json.dumps({'connections': connections[:int(params.get('limit', 4))]})
+
+
+def every(first, last, minutes, duration=30):
+    """
+    Returns a timetable with a connection every ``minutes`` from ``first``
+    to ``last`` included.
+    """
+    return [(departure, departure + duration * 60) for departure in range(first, last + 1, minutes * 60)]
+
+
+def test_sweep_finds_every_connection_of_the_window():
+    timetable = every(at(7, 50), at(10, 0), 7)
+    client = TimetableClient(timetable)
+    connections, requests = sweep_connections(client, 'A', 'B', at(8, 0), at(9, 0), 3)
+    departures = [departure for departure, _ in connections]
+    assert [departure for departure in departures if departure <= at(9, 0)] == [
+        departure for departure, _ in timetable if at(8, 0) <= departure <= at(9, 0)
+    ]
+    assert departures == sorted(set(departures))
+    assert requests == len(client.requests) < len(range(at(8, 0), at(9, 0) + 1, 60))
+
+
+def test_sweep_of_an_empty_timetable():
+    client = TimetableClient([])
+    assert sweep_connections(client, 'A', 'B', at(8, 0), at(9, 0), 4) == ([], 1)
+    assert client.requests == [('2026-10-17', '08:00')]
+
+
+def test_sweep_stops_on_an_empty_page():
+    # The last connection of the day departs in the window
+    timetable = [(at(8, 5), at(8, 35)), (at(8, 20), at(8, 50))]
+    client = TimetableClient(timetable)
+    connections, requests = sweep_connections(client, 'A', 'B', at(8, 0), at(9, 0), 4)
+    assert connections == timetable
+    # 08:00, then the minute of the last departure, then the next one,
+    # which is empty
+    assert client.requests == [('2026-10-17', '08:00'), ('2026-10-17', '08:20'), ('2026-10-17', '08:21')]
+    assert requests == 3
+
+
+def test_sweep_with_the_last_departure_at_the_end_of_the_window():
+    timetable = every(at(8, 0), at(8, 40), 10)
+    client = TimetableClient(timetable)
+    connections, requests = sweep_connections(client, 'A', 'B', at(8, 0), at(8, 30), 2)
+    assert [departure for departure, _ in connections if departure <= at(8, 30)] == [
+        at(8, 0), at(8, 10), at(8, 20), at(8, 30)
+    ]
+    assert requests == len(client.requests)
+    assert all(requested <= '08:30' for _, requested in client.requests)
+    assert connection_statistics(connections, at(8, 0), at(8, 30), 600)['count'] == 4
+
+
+def test_sweep_keeps_the_departures_cut_by_the_limit():
+    # Three connections depart at 08:10, the first request only returns two
+    # of them
+    timetable = [
+        (at(8, 0), at(8, 30)),
+        (at(8, 10), at(8, 40)), (at(8, 10), at(8, 45)), (at(8, 10, 30), at(8, 50)),
+        (at(8, 20), at(8, 50))
+    ]
+    client = TimetableClient(timetable)
+    connections, _requests = sweep_connections(client, 'A', 'B', at(8, 0), at(8, 30), 3)
+    assert connections == timetable
+
+
+def test_sweep_drops_duplicate_departures():
+    timetable = every(at(8, 0), at(9, 0), 1)
+    client = TimetableClient(timetable)
+    connections, _requests = sweep_connections(client, 'A', 'B', at(8, 0), at(8, 30), 4)
+    assert len(connections) == len(set(connections))
+    assert [connection for connection in connections if connection[0] <= at(8, 30)] == timetable[:31]
+
+
+def test_sweep_moves_on_from_a_minute_with_more_connections_than_the_limit():
+    timetable = [(at(8, 0, second), at(8, 30)) for second in range(0, 60, 10)] + [(at(8, 5), at(8, 35))]
+    client = TimetableClient(timetable)
+    connections, requests = sweep_connections(client, 'A', 'B', at(8, 0), at(8, 10), 2)
+    assert connections[-1] == (at(8, 5), at(8, 35))
+    assert client.requests[:2] == [('2026-10-17', '08:00'), ('2026-10-17', '08:01')]
+
+
+def test_sweep_is_canceled():
+    client = TimetableClient(every(at(8, 0), at(9, 0), 10))
+    assert sweep_connections(client, 'A', 'B', at(8, 0), at(9, 0), 2, lambda: True) == ([], 0)
+
+
+def test_connection_statistics():
+    connections = [(at(8, 0), at(8, 30)), (at(8, 20), at(9, 0)), (at(8, 50), at(9, 10)), (at(9, 10), at(9, 40))]
+    # Soonest connections of 08:00, 08:15, 08:30, 08:45 and 09:00: 30, 40,
+    # 20, 20 and 30 minutes
+    assert connection_statistics(connections, at(8, 0), at(9, 0), 15 * 60) == {
+        'count': 3, 'frequency': 3, 'min': 20, 'median': 30, 'max': 40
+    }
+
+
+def test_connection_statistics_without_connections():
+    assert connection_statistics([], at(8, 0), at(9, 0), 600) == {'count': 0, 'frequency': 0}
+    assert connection_statistics([], at(8, 0), at(8, 0), 600) == {'count': 0}
+
+
+def test_fetch_connection_duration_requests_the_exact_time():
+    timetable = [(at(8, 2), at(8, 50)), (at(8, 14), at(8, 44)), (at(8, 20), None), (at(8, 40), at(9, 0))]
+    client = TimetableClient(timetable)
+    assert fetch_connection_duration(client, 'A', 'B', '2026-10-17', '08:14') == 30
+    assert fetch_connection_duration(client, 'A', 'B', '2026-10-17', '08:14', fastest=True) == 20
+    assert client.requests == [('2026-10-17', '08:14')] * 2
+    assert fetch_connection_duration(client, 'A', 'B', '2026-10-17', '09:00') is None
+
+
+@pytest.fixture
+def server():
+    server = MockTransportServer().start()
+    yield server
+    server.stop()
+
+
+def test_fetch_connection_duration_with_and_without_cache(server, tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.sqlite'))
+    cached_client = SwissPublicTransportClient(base_url=server.url, cache=cache)
+    client = SwissPublicTransportClient(base_url=server.url)
+    for origin, destination in [('Bern', 'Zürich HB'), ('Lausanne', 'Genève')]:
+        for fastest in (False, True):
+            expected = fetch_connection_duration(client, origin, destination, '2026-10-17', '08:14', fastest)
+            assert expected is not None
+            for _ in range(2):
+                assert fetch_connection_duration(
+                    cached_client, origin, destination, '2026-10-17', '08:14', fastest
+                ) == expected
+    assert (cache.misses, cache.hits) == (2, 6)
+    cached_client.close()
+    client.close()